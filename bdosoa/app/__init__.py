@@ -3,6 +3,7 @@ bdosoa - CherryPy application
 """
 
 import cherrypy
+import json
 import os
 
 from bdosoa.app import soap, sync
@@ -31,24 +32,41 @@ class Root(object):
 
     @cherrypy.expose
     def query(self, query_string):
-        """Query BDO SVs
+        """Query the routes of TNs
 
-        :param str query_string: Query string
-        :return: The query result
+        :param str query_string: TNs separated by commas or whitespace
+        :return: The routes by TN, as JSON
         :rtype: str
         """
-        # todo: implement SV query
 
         if cherrypy.request.method != 'POST':
             cherrypy.response.headers['Allow'] = 'POST'
             raise cherrypy.HTTPError(405)
 
-        return query_string
+        tns = query_string.replace(',', ' ').split()
+
+        if not tns:
+            raise cherrypy.HTTPError(400, 'No TNs specified')
+
+        result = cherrypy.engine.publish('routing_lookup', tns)
+
+        if not result:
+            raise cherrypy.HTTPError(503, 'Routing table not available')
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(result.pop())
 
 App = cherrypy.Application(Root(), config={
     '/': {
         'tools.sqlalchemy.on': True,
     },
+    '/query': {
+        'tools.sqlalchemy.on': False,
+    },
+    '/sync/snapshot': {
+        'tools.gzip.on': True,
+        'tools.gzip.mime_types': ['application/x-ndjson', 'text/plain'],
+    },
     '/static': {
         'tools.sqlalchemy.on': False,
         'tools.staticdir.on': True,
@@ -3,24 +3,39 @@ bdosoa - SOAP requests processing
 """
 
 import cherrypy
+import json
 import libspg
+import sqlalchemy.event
 import sys
 
-from datetime import datetime
-from email.mime.text import MIMEText
+from datetime import datetime, timedelta
 from libspg.bdo import (BDRError, BDRtoBDO, BDOtoBDR, QueryBdoSVs,
                         SVCreateDownload, SVDeleteDownload, SVQueryReply)
+from sqlalchemy import and_, bindparam, select
 from traceback import format_exception
-from subprocess import Popen, PIPE
 
-from bdosoa.lib.soap import SOAPApplication, SOAPClient
-from bdosoa.model import ServiceProviderGateway, SubscriptionVersion, SyncTask
-from bdosoa.model.meta import NoResultFound
+from bdosoa.cherrypy.plugin import request_scope
+from bdosoa.lib.cache import LRUCache
+from bdosoa.lib.query import QueryCompiler, unquote
+from bdosoa.lib.scheduler import LaneScheduler
+from bdosoa.lib.spg import QueryBdoSVsStreamReply
+from bdosoa.lib.soap import (SOAPApplication, SOAPClient,
+                             close_connection_pools)
+from bdosoa.lib.sync import STORAGES
+from bdosoa.model import (InboundMessage, OutboundMessage,
+                          ProcessedMessage, ServiceProviderGateway,
+                          SubscriptionVersion)
+from bdosoa.model.meta import NoResultFound, publish_after_commit
 
 
 class SOAP(object):
     """Process SOAP requests"""
 
+    #: Messages whose retransmissions are detected and get the recorded
+    #: reply, must include every message changing data as the inbound queue
+    #: may process a message again
+    dedupe_messages = (SVCreateDownload, SVDeleteDownload)
+
     def __init__(self):
         self.__msg_handlers__ = {
             BDRError: lambda x: None,
@@ -33,6 +48,120 @@ class SOAP(object):
         self.soap_app = SOAPApplication(namespace='SPG/SoapServer')
         self.soap_app.register_method('processResponse', self.receive_soap)
 
+        # SOAP clients by Service Provider Gateway ID
+        self.soap_clients = {}
+
+        # Replies to processed messages by (SPG ID, invoke ID, message type)
+        self.processed_messages = LRUCache()
+
+        # Service Provider Gateway snapshots by (SPID, token)
+        self.gateways = LRUCache()
+
+        # QueryBdoSVs statements by normalized query expression
+        self.sv_queries = QueryCompiler(
+            dict((column.name, column)
+                 for column in SubscriptionVersion.__table__.columns
+                 if column.name.startswith('subscription_')),
+            self.sv_query)
+
+        # QueryBdoSVs serialized results by
+        # (SPG ID, normalized query expression, SPG data version)
+        self.sv_query_results = LRUCache(
+            sizeof=lambda result: len(result[1]))
+
+        # Message processing lanes, created on engine start if enabled
+        self.lanes = None
+
+        # Sync tasks storage, set on engine start by the sync mode
+        self.sync_storage = STORAGES['tasks']
+
+        for event in ('after_update', 'after_delete'):
+            sqlalchemy.event.listen(ServiceProviderGateway, event,
+                                    self.invalidate_gateways)
+
+        cherrypy.engine.subscribe('start', self.setup)
+        # Stop after the HTTP server and before the SQLAlchemy plugin
+        cherrypy.engine.subscribe('stop', self.teardown, priority=30)
+        cherrypy.engine.subscribe('soap_message_processed',
+                                  self.processed_messages.set)
+
+    def setup(self):
+        """Apply the configuration settings on engine start"""
+
+        # Pretty print responses by default except on production
+        self.soap_app.pretty_print = cherrypy.config.get(
+            'soap_pretty_print',
+            cherrypy.config.get('environment') != 'production')
+
+        self.processed_messages.max_size = cherrypy.config.get(
+            'soap_dedupe_cache_size', 10000)
+        self.processed_messages.ttl = cherrypy.config.get(
+            'soap_dedupe_ttl', 3600)
+
+        self.gateways.max_size = cherrypy.config.get(
+            'credentials_cache_size', 1000)
+        self.gateways.ttl = cherrypy.config.get('credentials_cache_ttl', 60)
+
+        self.sync_storage = STORAGES[cherrypy.config.get('sync_mode', 'tasks')]
+
+        self.sv_queries.cache.max_size = cherrypy.config.get(
+            'soap_query_cache_size', 256)
+        self.sv_query_results.max_size = cherrypy.config.get(
+            'soap_query_result_cache_size', 256)
+        self.sv_query_results.max_bytes = cherrypy.config.get(
+            'soap_query_result_cache_bytes', 64 * 1024 * 1024)
+
+        lanes = cherrypy.config.get('soap_lanes', 0)
+
+        if lanes:
+            cherrypy.engine.log('Starting {0} message processing lanes.'
+                                .format(lanes))
+            self.lanes = LaneScheduler(lanes, 'soap-lane')
+            self.lanes.start()
+
+    def teardown(self):
+        """Stop the processing lanes and release the SOAP clients on engine
+        stop
+        """
+
+        if self.lanes is not None:
+            cherrypy.engine.log('Stopping message processing lanes.')
+            self.lanes.stop()
+            self.lanes = None
+
+        self.soap_clients.clear()
+        close_connection_pools()
+
+    # noinspection PyUnusedLocal
+    def invalidate_gateways(self, *args):
+        """Clear the cached Service Provider Gateway credentials"""
+
+        self.gateways.clear()
+
+    def soap_client(self, spg):
+        """Get the SOAP client for a Service Provider Gateway
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :return: The SOAP client
+        :rtype: SOAPClient
+        """
+
+        soap_client = self.soap_clients.get(spg.id)
+
+        # Create a new client if the gateway URL changed
+        if soap_client is None or soap_client.__url__ != spg.soap_url:
+            soap_client = SOAPClient(
+                spg.soap_url, 'SPG/SoapServer',
+                pool_size=cherrypy.config.get('soap_client_pool_size', 4),
+                idle_timeout=cherrypy.config.get(
+                    'soap_client_idle_timeout', 60),
+                timeout=cherrypy.config.get('soap_client_timeout', 30),
+            )
+
+            self.soap_clients[spg.id] = soap_client
+
+        return soap_client
+
     @staticmethod
     def logger(msg="", msg_obj=None, context='', severity=20, traceback=False):
         """Log messages
@@ -57,6 +186,28 @@ class SOAP(object):
         cherrypy.log.error(msg=msg, context=context, severity=severity,
                            traceback=traceback)
 
+    @cherrypy.expose
+    def lanes_status(self, spid=None, token=None):
+        """Message processing lanes status
+
+        :param str spid: Service provider ID
+        :param str token: Access token
+        :return: The number of lanes, queued and processed messages per lane,
+         as JSON
+        :rtype: str
+        """
+
+        self.authenticate(spid, token)
+
+        lanes = self.lanes
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({
+            'lanes': len(lanes) if lanes is not None else 0,
+            'depth': lanes.depths() if lanes is not None else [],
+            'processed': list(lanes.processed) if lanes is not None else [],
+        })
+
     @cherrypy.expose
     def index(self, spid=None, token=None):
         """Receive SOAP envelope
@@ -71,24 +222,51 @@ class SOAP(object):
             cherrypy.response.headers['Allow'] = 'POST'
             raise cherrypy.HTTPError(405)
 
-        # Check access credentials
-        try:
-            cherrypy.request.service_provider_gateway = \
-                cherrypy.request.db.query(ServiceProviderGateway).filter_by(
-                    service_provider_id=spid, token=token, enabled=True
-                ).one()
-
-        except NoResultFound:
-            raise cherrypy.HTTPError(403)
+        self.authenticate(spid, token)
 
         # Process request
-        status_code, response = \
-            self.soap_app.process_request(cherrypy.request.body.read())
+        if cherrypy.config.get('soap_streaming', False):
+            status_code, response = self.soap_app.process_stream(
+                cherrypy.request.body,
+                cherrypy.config.get('soap_streaming_chunk_size', 65536))
+
+        else:
+            status_code, response = \
+                self.soap_app.process_request(cherrypy.request.body.read())
 
         # Return response
         cherrypy.response.status = status_code
         return response
 
+    def authenticate(self, spid, token):
+        """Check the access credentials of a Service Provider Gateway
+
+        :param str spid: Service provider ID
+        :param str token: Access token
+        :return: The gateway snapshot, also set on the request
+        :raises cherrypy.HTTPError: 403 if the credentials are invalid
+        """
+
+        # Check access credentials
+        spg = self.gateways.get((spid, token))
+
+        if spg is None:
+            try:
+                spg = cherrypy.request.db.query(
+                    ServiceProviderGateway
+                ).filter_by(
+                    service_provider_id=spid, token=token, enabled=True
+                ).one().snapshot()
+
+            except NoResultFound:
+                raise cherrypy.HTTPError(403)
+
+            self.gateways.set((spid, token), spg)
+
+        cherrypy.request.service_provider_gateway = spg
+
+        return spg
+
     # noinspection PyPep8Naming,PyUnusedLocal
     def receive_soap(self, header, xmlMessage):
         """Receive SOAP request and enqueue message for processing
@@ -99,8 +277,62 @@ class SOAP(object):
         :rtype: str
         """
 
+        msg_obj = self.parse_message(xmlMessage)
+
+        # Store the message to be processed by the inbound workers, the
+        # malformed messages are still refused to the SPG
+        if cherrypy.config.get('soap_async_input', False):
+            cherrypy.request.db.add(InboundMessage(
+                service_provider_gateway_id=(
+                    cherrypy.request.service_provider_gateway.id),
+                header=header,
+                message=xmlMessage,
+            ))
+
+            publish_after_commit(cherrypy.request.db(), 'inbound_notify')
+
+            return '0'
+
+        lane_key = self.lane_key(msg_obj)
+
+        # Process the message on its lane, serialized with the other
+        # messages for the same subscription version. Messages of the same
+        # gateway only wait for each other from the data version bump, right
+        # before the commit, so the subscription versions of different lanes
+        # are saved in parallel
+        if self.lanes is not None and lane_key is not None:
+            return self.lanes.submit(
+                lane_key, self.process_lane_message,
+                cherrypy.request.service_provider_gateway, msg_obj
+            ).wait()
+
+        return self.process_spg_message(msg_obj)
+
+    # noinspection PyUnusedLocal
+    def process_xml_message(self, header, xml_message):
+        """Process a SPG message
+
+        :param str header: Message header
+        :param str xml_message: Message
+        :return: "0" if no errors occurred else "-1"
+        :rtype: str
+        """
+
+        return self.process_spg_message(self.parse_message(xml_message))
+
+    @staticmethod
+    def parse_message(xml_message):
+        """Parse and check a SPG message
+
+        :param str xml_message: Message
+        :return: The message object
+        :rtype: libspg.Message
+        :raises ValueError: If the message SPID does not match the gateway
+        :raises TypeError: If the message is not a BDR to BDO message
+        """
+
         spg = cherrypy.request.service_provider_gateway
-        msg_obj = libspg.Message.from_string(xmlMessage)
+        msg_obj = libspg.Message.from_string(xml_message)
 
         # Check the service provider id on the SPG message
         if msg_obj.service_prov_id != spg.service_provider_id:
@@ -112,42 +344,212 @@ class SOAP(object):
         if not isinstance(msg_obj, BDRtoBDO):
             raise TypeError('Invalid message: {0!r}'.format(msg_obj))
 
+        return msg_obj
+
+    @staticmethod
+    def lane_key(msg_obj):
+        """Get the scheduling key of a message
+
+        :param libspg.Message msg_obj: Message object
+        :return: The SPG and subscription version IDs or None for messages
+         not changing a subscription version
+        :rtype: tuple
+        """
+
+        spg = cherrypy.request.service_provider_gateway
+
+        if isinstance(msg_obj, SVCreateDownload):
+            return spg.id, msg_obj.message_content.\
+                subscription_tn_version_id.version_id
+
+        if isinstance(msg_obj, SVDeleteDownload):
+            return spg.id, msg_obj.message_content.subscription_version_id
+
+    def process_lane_message(self, spg, msg_obj):
+        """Process a SPG message on a lane thread
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param libspg.Message msg_obj: Message object
+        :return: "0" if no errors occurred else "-1"
+        :rtype: str
+        """
+
+        with request_scope(service_provider_gateway=spg):
+            return self.process_spg_message(msg_obj)
+
+    def process_spg_message(self, msg_obj):
+        """Process a checked SPG message
+
+        :param libspg.Message msg_obj: Message object
+        :return: "0" if no errors occurred else "-1"
+        :rtype: str
+        """
+
+        spg = cherrypy.request.service_provider_gateway
+
+        # Replies sent right away, see :meth:`output`
+        cherrypy.request.spg_replies = replies = []
+
+        # Changed subscription versions, see :meth:`save_changes`
+        cherrypy.request.sv_changes = []
+
         # Process SPG message
         try:
-            self.process_message(msg_obj)
+            key = (spg.id, msg_obj.invoke_id, msg_obj.__class__.__name__)
+            dedupe = isinstance(msg_obj, self.dedupe_messages)
+            reply = self.processed_reply(key) if dedupe else None
+
+            # Retransmitted message, just send the reply again
+            if reply is not None:
+                self.logger('Message already processed.', msg_obj)
+
+                if reply:
+                    self.process_message(libspg.Message.from_string(reply))
+
+            elif not dedupe:
+                self.process_message(msg_obj)
+
+            else:
+                reply = self.process_message(msg_obj)
+                reply = str(reply) if reply is not None else ''
+
+                # Replace the expired record of a reused invoke ID, kept
+                # until it is purged
+                cherrypy.request.db.query(ProcessedMessage).filter(
+                    ProcessedMessage.service_provider_gateway_id == spg.id,
+                    ProcessedMessage.invoke_id == msg_obj.invoke_id,
+                    ProcessedMessage.message_type ==
+                    msg_obj.__class__.__name__,
+                    ProcessedMessage.created < self.processed_expiration(),
+                ).delete(synchronize_session=False)
+
+                cherrypy.request.db.add(ProcessedMessage(
+                    service_provider_gateway_id=spg.id,
+                    invoke_id=msg_obj.invoke_id,
+                    message_type=msg_obj.__class__.__name__,
+                    reply=reply or None,
+                ))
+
+                publish_after_commit(cherrypy.request.db(),
+                                     'soap_message_processed', key, reply)
+
+            self.save_changes(spg, msg_obj)
+
+            # Commit before sending the replies, so the locks taken by the
+            # changes are not held during the SPG round trip
+            cherrypy.request.db.commit()
 
         # Log and mail the exception if the processing fails
         except:
-            self.logger('Error processing message.', msg_obj, severity=40,
-                        traceback=True)
-
-            mail = MIMEText(''.join(format_exception(*sys.exc_info())))
-            mail['To'] = 'root'
-            mail['Subject'] = 'BDOSOA - Error processing message {0} for ' \
-                              'Service Provider "{1}"' \
-                .format(msg_obj.invoke_id, spg.description)
-
-            p = Popen(['/usr/sbin/sendmail', '-t'], stdin=PIPE)
-            p.communicate(mail.as_string())
-            p.stdin.close()
-            p.wait()
+            self.processing_error(spg, msg_obj)
 
             # Rollback database session
             cherrypy.request.db.rollback()
 
             return '-1'
 
+        # The changes are kept if a reply is not sent, the SPG retransmits the
+        # message and the saved reply is sent again
+        try:
+            for header, message in replies:
+                self.logger('Sending message to: {0}'
+                            .format(spg.soap_url), msg_obj, severity=10)
+                self.send(spg, header, message)
+
+        except:
+            self.processing_error(spg, msg_obj)
+
+            return '-1'
+
         return '0'
 
+    def processing_error(self, spg, msg_obj):
+        """Log and mail the exception raised processing a message
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param libspg.Message msg_obj: Message object
+        """
+
+        self.logger('Error processing message.', msg_obj, severity=40,
+                    traceback=True)
+
+        error = ''.join(format_exception(*sys.exc_info()))
+        cherrypy.engine.publish(
+            'notify', (spg.id, error),
+            'BDOSOA - Error processing messages for Service Provider '
+            '"{0}"'.format(spg.description),
+            error, 'Message {0}'.format(msg_obj.invoke_id))
+
+    def processed_reply(self, key):
+        """Get the reply sent to an already processed message
+
+        :param tuple key: SPG ID, invoke ID and message type
+        :return: The serialized reply, an empty string if the message had no
+         reply or None if the message was not processed yet
+        :rtype: str
+        """
+
+        reply = self.processed_messages.get(key)
+
+        if reply is None:
+            spg_id, invoke_id, message_type = key
+
+            try:
+                reply = cherrypy.request.db.query(
+                    ProcessedMessage.reply
+                ).filter(
+                    ProcessedMessage.service_provider_gateway_id == spg_id,
+                    ProcessedMessage.invoke_id == invoke_id,
+                    ProcessedMessage.message_type == message_type,
+                    ProcessedMessage.created >= self.processed_expiration(),
+                ).one().reply or ''
+
+            except NoResultFound:
+                return None
+
+            self.processed_messages.set(key, reply)
+
+        return reply
+
+    def processed_expiration(self):
+        """Get the creation time of the oldest valid processed message record
+
+        :rtype: datetime
+        """
+
+        return datetime.utcnow() - timedelta(
+            seconds=self.processed_messages.ttl)
+
+    def purge_processed_messages(self):
+        """Remove the expired processed messages records"""
+
+        session = cherrypy.engine.publish(
+            'sqlalchemy_get_session').pop().session_factory()
+
+        try:
+            count = session.query(ProcessedMessage).filter(
+                ProcessedMessage.created < self.processed_expiration(),
+            ).delete(synchronize_session=False)
+
+            session.commit()
+
+        finally:
+            session.close()
+
+        self.logger('Removed {0} expired processed messages records.'
+                    .format(count), severity=10)
+
     def process_message(self, msg_obj):
         """Process SPG messages
 
         :param libspg.Message msg_obj: Message object
+        :return: The reply to inbound messages
+        :rtype: libspg.Message
         """
 
         # Inbound messages
         if isinstance(msg_obj, BDRtoBDO):
-            self.input(msg_obj)
+            return self.input(msg_obj)
 
         # Outbound messages
         elif isinstance(msg_obj, BDOtoBDR):
@@ -160,6 +562,8 @@ class SOAP(object):
         """Process inbound messages
 
         :param libspg.Message msg_obj: Message object
+        :return: The reply message
+        :rtype: libspg.Message
         """
 
         self.logger('Received message.', msg_obj, severity=10)
@@ -185,36 +589,61 @@ class SOAP(object):
 
         self.logger('Finished processing message.', msg_obj, severity=10)
 
+        return reply
+
     def output(self, msg_obj):
         """Output handling thread
 
+        Messages are queued for the outbound workers if asynchronous output
+        is enabled, otherwise they are sent right after the processed message
+        changes are committed.
+
         :param libspg.Message msg_obj: Message object
         """
 
         spg = cherrypy.request.service_provider_gateway
 
-        self.logger('Sending message.', msg_obj)
-        self.logger('Sending message to: {0}'
-                    .format(spg.soap_url), msg_obj, severity=10)
-
-        soap_client = SOAPClient(spg.soap_url, 'SPG/SoapServer')
-
         header = '{0}|{1}|{2:%s}'.format(
             msg_obj.service_prov_id,
             msg_obj.invoke_id,
             msg_obj.message_date_time,
         )
 
+        # Queue the message to be sent by the outbound workers
+        if cherrypy.config.get('soap_async_output', False):
+            self.logger('Queueing message.', msg_obj)
+
+            cherrypy.request.db.add(OutboundMessage(
+                service_provider_gateway_id=spg.id,
+                header=header,
+                message=str(msg_obj),
+            ))
+
+            publish_after_commit(cherrypy.request.db(), 'outbound_notify')
+
         # Send the message to the service provider SPG
-        response = soap_client.processRequest(
-            header=header, message=str(msg_obj))
+        else:
+            self.logger('Sending message.', msg_obj)
+
+            cherrypy.request.spg_replies.append((header, str(msg_obj)))
+
+        self.logger('Finished processing message.', msg_obj, severity=10)
+
+    def send(self, spg, header, message):
+        """Send a message to a Service Provider Gateway
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param str header: Message header
+        :param str message: Message
+        """
+
+        response = self.soap_client(spg).processRequest(
+            header=header, message=message)
 
         # Check the SPG response
         if response != ('0',):
             raise ValueError('Received "{0}" from SPG'.format(response))
 
-        self.logger('Finished processing message.', msg_obj, severity=10)
-
     def process_sv_create_download(self, msg_obj):
         """Create new subscription version
 
@@ -224,56 +653,43 @@ class SOAP(object):
         tn_version_id = msg_obj.message_content.subscription_tn_version_id
         data = msg_obj.message_content.subscription_data
 
-        # Get the subscription version
-        try:
-            sv = spg.subscription_versions.filter_by(
-                subscription_version_id=tn_version_id.version_id,
-            ).one()
-
-            self.logger('Updating subscription version: {0}'.format(
-                tn_version_id.version_id), msg_obj)
-
-        # Create a new subscription version if it does not already exist
-        except NoResultFound:
-            sv = SubscriptionVersion(
-                service_provider_gateway_id=spg.id,
-                subscription_version_id=tn_version_id.version_id,
-            )
-            cherrypy.request.db.add(sv)
-            cherrypy.request.db.flush()
-
-            self.logger('New subscription version: {0}'.format(
-                tn_version_id.version_id), msg_obj)
-
-        # Update the subscription version attributes
-        sv.subscription_version_tn = tn_version_id.tn
-        sv.subscription_recipient_sp = data.subscription_recipient_sp
-        sv.subscription_recipient_eot = data.subscription_recipient_eot
-        sv.subscription_activation_timestamp = \
-            data.subscription_activation_timestamp
-        sv.subscription_broadcast_timestamp = \
-            data.broadcast_window_start_timestamp or None
-        sv.subscription_rn1 = data.subscription_rn1
-        sv.subscription_new_cnl = data.subscription_new_cnl
-        sv.subscription_lnp_type = data.subscription_lnp_type
-        sv.subscription_line_type = data.subscription_line_type
-        sv.subscription_optional_data = data.subscription_optional_data
+        self.logger('Saving subscription version: {0}'.format(
+            tn_version_id.version_id), msg_obj)
+
+        values = {
+            'subscription_version_tn': tn_version_id.tn,
+            'subscription_recipient_sp': data.subscription_recipient_sp,
+            'subscription_recipient_eot': data.subscription_recipient_eot,
+            'subscription_activation_timestamp':
+                data.subscription_activation_timestamp,
+            'subscription_broadcast_timestamp':
+                data.broadcast_window_start_timestamp or None,
+            'subscription_rn1': data.subscription_rn1,
+            'subscription_new_cnl': data.subscription_new_cnl,
+            'subscription_lnp_type': data.subscription_lnp_type,
+            'subscription_download_reason': data.subscription_download_reason,
+            'subscription_line_type': data.subscription_line_type,
+            'subscription_optional_data': data.subscription_optional_data,
+        }
 
+        # Create or update the subscription version
         # Do not change the download reason on deleted subscription versions
         # This allows for a create or modify message to be processed after a
         # delete message keeping the subscription version state
-        if sv.subscription_deletion_timestamp is None:
-            sv.subscription_download_reason = data.subscription_download_reason
+        sv = SubscriptionVersion.upsert(
+            cherrypy.request.db, spg.id, tn_version_id.version_id, values,
+            keep_on_deleted=['subscription_download_reason'])
 
-        # Create the sync tasks
-        for client in spg.sync_clients.filter_by(enabled=True):
-            task = SyncTask(sync_client_id=client.id,
-                            subscription_version_id=sv.id)
-            cherrypy.request.db.add(task)
-            cherrypy.request.db.flush()
+        # Create the sync tasks at the end of the transaction
+        cherrypy.request.sv_changes.append(sv.id)
 
-            self.logger('Added sync task: {0}'
-                        .format(task.id), msg_obj, severity=10)
+        # Update the routing table
+        if sv.subscription_deletion_timestamp is None:
+            publish_after_commit(
+                cherrypy.request.db(), 'routing_update',
+                tn_version_id.tn, tn_version_id.version_id,
+                data.subscription_rn1, data.subscription_recipient_sp,
+                data.subscription_new_cnl)
 
         return msg_obj.reply()
 
@@ -287,42 +703,103 @@ class SOAP(object):
         version_id = msg_obj.message_content.subscription_version_id
         data = msg_obj.message_content.subscription_delete_data
 
-        # Get the subscription version
-        try:
-            sv = spg.subscription_versions.filter_by(
-                subscription_version_id=version_id,
-            ).one()
-
-        # Subscription version not created yet, create a new deleted
-        # subscription version to ensure asynchronous processing
-        except NoResultFound:
-            sv = SubscriptionVersion(
-                service_provider_gateway_id=spg.id,
-                subscription_version_id=version_id,
-            )
-            cherrypy.request.db.add(sv)
-            cherrypy.request.db.flush()
-
-        # Update the subscription version attributes
-        sv.subscription_download_reason = data.subscription_download_reason
-        sv.subscription_deletion_timestamp = \
-            data.broadcast_window_start_timestamp or datetime.utcnow()
+        # Mark the subscription version as deleted, creating a new deleted
+        # subscription version if it does not exist yet to ensure
+        # asynchronous processing
+        sv = SubscriptionVersion.upsert(
+            cherrypy.request.db, spg.id, version_id, {
+                'subscription_download_reason':
+                    data.subscription_download_reason,
+                'subscription_deletion_timestamp':
+                    data.broadcast_window_start_timestamp or
+                    datetime.utcnow(),
+            })
 
         self.logger('Removed subscription version: {0}'
                     .format(version_id), msg_obj)
 
-        # Create the sync tasks
-        for client in spg.sync_clients.filter_by(enabled=True):
-            task = SyncTask(sync_client_id=client.id,
-                            subscription_version_id=sv.id)
-            cherrypy.request.db.add(task)
-            cherrypy.request.db.flush()
+        # Create the sync tasks at the end of the transaction
+        cherrypy.request.sv_changes.append(sv.id)
 
-            self.logger('Added sync task: {0}'
-                        .format(task.id), msg_obj, severity=10)
+        # Update the routing table
+        publish_after_commit(cherrypy.request.db(), 'routing_delete',
+                             sv.subscription_version_tn, version_id)
 
         return msg_obj.reply()
 
+    def save_changes(self, spg, msg_obj):
+        """Record the subscription versions changed by a message
+
+        The gateway data version is bumped, expiring the cached query
+        results, and the sync tasks are created right before the commit. The
+        version update locks the gateway row until the commit, so the tasks
+        are committed in the order of their IDs, but the subscription
+        versions are saved before taking the lock, in parallel with the
+        other messages of the gateway.
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param libspg.Message msg_obj: Message object
+        """
+
+        if not cherrypy.request.sv_changes:
+            return
+
+        self.bump_data_version(spg)
+
+        for sv_id in cherrypy.request.sv_changes:
+            self.create_sync_tasks(spg, sv_id, msg_obj)
+
+    @staticmethod
+    def bump_data_version(spg):
+        """Increment the gateway data version, expiring the cached results
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        """
+
+        cherrypy.request.db.execute(
+            ServiceProviderGateway.__table__.update().where(
+                ServiceProviderGateway.id == spg.id
+            ).values(data_version=ServiceProviderGateway.data_version + 1))
+
+    def create_sync_tasks(self, spg, sv_id, msg_obj):
+        """Create the sync tasks for a subscription version
+
+        The tasks are stored as set by the ``sync_mode`` setting, see
+        :mod:`bdosoa.lib.sync`.
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param int sv_id: Subscription version primary key
+        :param libspg.Message msg_obj: Message object
+        """
+
+        count = self.sync_storage.create(cherrypy.request.db, spg.id, sv_id)
+
+        self.logger('Added {0} sync tasks for subscription version: {1}'
+                    .format(count, sv_id), msg_obj, severity=10)
+
+        # Wake the sync clients waiting for tasks
+        if count:
+            publish_after_commit(cherrypy.request.db(), 'sync_tasks_created',
+                                 spg.id)
+
+    @staticmethod
+    def sv_query(criterion):
+        """Build the QueryBdoSVs statement for a query expression
+
+        The gateway ID is bound on execution as the ``spg_id`` parameter.
+
+        :param criterion: Compiled query expression
+        :return: The select statement
+        """
+
+        sv = SubscriptionVersion.__table__
+
+        return select([sv]).where(and_(
+            sv.c.service_provider_gateway_id == bindparam('spg_id'),
+            sv.c.subscription_deletion_timestamp.is_(None),
+            criterion,
+        )).execution_options(stream_results=True)
+
     def process_query_bdo_svs(self, msg_obj):
         """Query subscription versions
 
@@ -334,44 +811,37 @@ class SOAP(object):
 
         self.logger('Query string: {0}'.format(query_string), msg_obj)
 
-        if query_string.startswith('"') and query_string.endswith('"'):
-            query_string = query_string.lstrip('" ').rstrip(' "')
-
-        if not query_string:
-            raise ValueError('A query expression must be specified')
-
-        # Get the subscription versions
-        svs = spg.subscription_versions.filter_by(
-            subscription_deletion_timestamp=None,
-        ).filter(query_string).all()
-
-        # Build the query response
-        query_result = [
-            libspg.SubscriptionVersionData(
-                libspg.TNVersionId(
-                    tn=sv.subscription_version_tn,
-                    version_id=sv.subscription_version_id,
-                ),
-                libspg.SubscriptionData(
-                    subscription_recipient_sp=sv.subscription_recipient_sp,
-                    subscription_recipient_eot=sv.subscription_recipient_eot,
-                    subscription_activation_timestamp=sv.subscription_activation_timestamp,
-                    broadcast_window_start_timestamp=sv.subscription_broadcast_timestamp,
-                    subscription_rn1=sv.subscription_rn1,
-                    subscription_new_cnl=sv.subscription_new_cnl,
-                    subscription_lnp_type=sv.subscription_lnp_type,
-                    subscription_download_reason=sv.subscription_download_reason,
-                    subscription_line_type=sv.subscription_line_type,
-                    subscription_optional_data=sv.subscription_optional_data,
-                )
-            )
+        expression, statement = self.sv_queries.compile(unquote(query_string))
+        message_header = msg_obj.reply([]).message_header
+
+        # Reuse the result if the gateway data did not change since cached
+        data_version = cherrypy.request.db.query(
+            ServiceProviderGateway.data_version
+        ).filter_by(id=spg.id).scalar()
+
+        key = (spg.id, expression, data_version)
+        result = self.sv_query_results.get(key)
+
+        if result is not None:
+            self.logger('Query result cached.', msg_obj, severity=10)
+
+            count, content = result
+            reply = QueryBdoSVsStreamReply(message_header, content=content,
+                                           count=count)
+
+        # Build the query response as the rows are fetched
+        else:
+            reply = QueryBdoSVsStreamReply(
+                message_header,
+                cherrypy.request.db.execute(statement, {'spg_id': spg.id}))
+            str(reply)
 
-            for sv in svs
-        ]
+            if reply.count <= cherrypy.config.get(
+                    'soap_query_result_max_rows', 10000):
+                self.sv_query_results.set(key, (reply.count, reply.content))
 
-        self.logger('Query result: {0}'
-                    .format([sv.subscription_tn_version_id.version_id
-                             for sv in query_result]), msg_obj, severity=10)
+        self.logger('Query result: {0} subscription versions'
+                    .format(reply.count), msg_obj, severity=10)
 
         # Send the query result
-        return msg_obj.reply(query_result)
+        return reply
@@ -4,9 +4,17 @@ bdosoa - Subscription Versions syncing
 
 import cherrypy
 import json
+import sqlalchemy.event
+import threading
+import time
 
+from sqlalchemy import and_, select
+
+from bdosoa.lib.bdd import bdd_line
+from bdosoa.lib.cache import LRUCache
+from bdosoa.lib.sync import STORAGES
 from bdosoa.model import (ServiceProviderGateway, SubscriptionVersion,
-                          SyncClient, SyncTask)
+                          SyncClient)
 from bdosoa.model.meta import NoResultFound
 
 
@@ -14,13 +22,132 @@ from bdosoa.model.meta import NoResultFound
 class Sync(object):
     """Process Sync requests"""
 
+    def __init__(self):
+        # Sync client snapshots by (SPID, token)
+        self.clients = LRUCache()
+
+        for model in (ServiceProviderGateway, SyncClient):
+            for event in ('after_update', 'after_delete'):
+                sqlalchemy.event.listen(model, event, self.invalidate_clients)
+
+        # Sync tasks storage, set on engine start by the sync mode
+        self.storage = STORAGES['tasks']
+
+        # Sync task creation counters by gateway ID, for the waiting requests
+        self.generations = {}
+        self.condition = threading.Condition()
+        self.stopping = False
+
+        # Requests waiting for tasks, limited below the HTTP thread pool
+        # size, set on engine start
+        self.waiters = threading.Semaphore(0)
+
+        cherrypy.engine.subscribe('start', self.setup)
+        # Release the waiting requests before the HTTP server stops, as it
+        # waits for the requests to finish
+        cherrypy.engine.subscribe('stop', self.teardown, priority=20)
+        cherrypy.engine.subscribe('sync_tasks_created', self.tasks_created)
+
+    def setup(self):
+        """Apply the configuration settings on engine start"""
+
+        self.clients.max_size = cherrypy.config.get(
+            'credentials_cache_size', 1000)
+        self.clients.ttl = cherrypy.config.get('credentials_cache_ttl', 60)
+
+        self.storage = STORAGES[cherrypy.config.get('sync_mode', 'tasks')]
+
+        # Keep threads free for the other requests, waiting requests hold
+        # a thread of the HTTP server pool until they end
+        thread_pool = cherrypy.server.thread_pool
+        concurrency = cherrypy.config.get('sync_wait_concurrency',
+                                          thread_pool // 2)
+
+        if concurrency >= thread_pool:
+            concurrency = thread_pool - 1
+            cherrypy.log.error('Waiting requests limited to {0}, below the '
+                               'HTTP thread pool size.'.format(concurrency),
+                               'SYNC', 30)
+
+        self.waiters = threading.Semaphore(max(concurrency, 0))
+
+        with self.condition:
+            self.stopping = False
+
+    def teardown(self):
+        """Release the waiting requests on engine stop"""
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def truncate_changes(self):
+        """Remove the changes acknowledged by all the sync clients"""
+
+        storage = STORAGES['changelog']
+        session = cherrypy.engine.publish(
+            'sqlalchemy_get_session').pop().session_factory()
+
+        try:
+            count = storage.truncate(session)
+            session.commit()
+
+        finally:
+            session.close()
+
+        cherrypy.log.error('Removed {0} acknowledged changes.'
+                           .format(count), 'SYNC', 10)
+
+    def tasks_created(self, spg_id):
+        """Wake the requests waiting for tasks of a gateway
+
+        :param int spg_id: Service Provider Gateway ID
+        """
+
+        with self.condition:
+            self.generations[spg_id] = self.generations.get(spg_id, 0) + 1
+            self.condition.notify_all()
+
+    def wait_tasks(self, spg_id, generation, deadline):
+        """Wait for new tasks of a gateway
+
+        :param int spg_id: Service Provider Gateway ID
+        :param int generation: Task creation counter seen by the request
+        :param float deadline: Time to stop waiting
+        :return: True if tasks were created
+        :rtype: bool
+        """
+
+        with self.condition:
+            while self.generations.get(spg_id, 0) == generation:
+                remaining = deadline - time.time()
+
+                if remaining <= 0 or self.stopping:
+                    return False
+
+                self.condition.wait(remaining)
+
+        return True
+
+    # noinspection PyUnusedLocal
+    def invalidate_clients(self, *args):
+        """Clear the cached sync client credentials"""
+
+        self.clients.clear()
+
+    # noinspection PyUnusedLocal
     @cherrypy.expose
-    def index(self, spid, token, task=None):
+    def index(self, spid, token, task=None, after=None, limit=None,
+              wait=None, upto=None):
         """Receive Sync or Subscription Version requests
 
         :param str spid: Service Provider ID
         :param str token: access token
         :param str task: Sync Task ID
+        :param str after: Task list cursor, see :meth:`GET`
+        :param str limit: Task list page size, see :meth:`GET`
+        :param str wait: Task list wait seconds, see :meth:`GET`
+        :param str upto: Last task ID to delete, see :meth:`DELETE`
         """
 
         # Get handler based on request method
@@ -34,29 +161,17 @@ class Sync(object):
                 [m for m in dir(self) if m.isupper()]
             raise cherrypy.HTTPError(405)
 
-        # Check access credentials
-        try:
-            cherrypy.request.sync_client = cherrypy.request.db \
-                .query(SyncClient) \
-                .join(ServiceProviderGateway) \
-                .filter(
-                    ServiceProviderGateway.service_provider_id == spid,
-                    SyncClient.token == token,
-                    SyncClient.enabled,
-                ).one()
-
-        except NoResultFound:
-            raise cherrypy.HTTPError(403)
-
-        # Get tasks
+        self.authenticate(spid, token)
+
+        # Get task IDs
         if task:
             if isinstance(task, (str, unicode)):
                 task = [task]
 
-            tasks = cherrypy.request.sync_client.tasks.filter(
-                SyncTask.id.in_(task))
+            try:
+                tasks = sorted(set(int(t) for t in task))
 
-            if tasks.count() < len(task):
+            except ValueError:
                 raise cherrypy.HTTPError(404)
 
         else:
@@ -66,45 +181,331 @@ class Sync(object):
         cherrypy.response.headers['Content-Type'] = 'application/json'
         return handler(tasks)
 
+    def authenticate(self, spid, token):
+        """Check the access credentials of a sync client
+
+        :param str spid: Service Provider ID
+        :param str token: access token
+        :return: The sync client snapshot, also set on the request
+        :raises cherrypy.HTTPError: 403 if the credentials are invalid
+        """
+
+        # Check access credentials
+        sync_client = self.clients.get((spid, token))
+
+        if sync_client is None:
+            try:
+                sync_client = cherrypy.request.db \
+                    .query(SyncClient) \
+                    .join(ServiceProviderGateway) \
+                    .filter(
+                        ServiceProviderGateway.service_provider_id == spid,
+                        SyncClient.token == token,
+                        SyncClient.enabled,
+                    ).one().snapshot()
+
+            except NoResultFound:
+                raise cherrypy.HTTPError(403)
+
+            self.clients.set((spid, token), sync_client)
+
+        cherrypy.request.sync_client = sync_client
+
+        return sync_client
+
+    # noinspection PyShadowingBuiltins
+    @cherrypy.expose
+    def snapshot(self, spid, token, format='ndjson'):
+        """Stream the current subscription versions of the gateway
+
+        Used to bootstrap new sync clients: the ``X-Sync-Position`` response
+        header has the last pending task ID when the snapshot was taken, the
+        tasks up to it may be acknowledged and the following ones fetched
+        after the snapshot is loaded. Tasks created while the snapshot is
+        taken may repeat data already on it.
+
+        :param str spid: Service Provider ID
+        :param str token: access token
+        :param str format: ``ndjson`` for one JSON object per subscription
+         version or ``bdd`` for the BDD file format
+        """
+
+        if cherrypy.request.method not in ('GET', 'HEAD'):
+            cherrypy.response.headers['Allow'] = 'GET, HEAD'
+            raise cherrypy.HTTPError(405)
+
+        if format not in ('ndjson', 'bdd'):
+            raise cherrypy.HTTPError(400, 'Invalid snapshot format')
+
+        db = cherrypy.request.db
+        sync_client = self.authenticate(spid, token)
+
+        # The position is read first, so changes saved meanwhile are not lost
+        position = db.execute(self.storage.position(sync_client)).scalar()
+        cherrypy.response.headers['X-Sync-Position'] = str(position or 0)
+
+        sv = SubscriptionVersion.__table__
+        result = db.execute(select([sv]).where(and_(
+            sv.c.service_provider_gateway_id ==
+            sync_client.service_provider_gateway_id,
+            sv.c.subscription_deletion_timestamp.is_(None),
+        )).execution_options(stream_results=True))
+
+        cherrypy.log.error('Sending snapshot up to task {0}'
+                           .format(position), 'SYNC', 10)
+
+        if format == 'bdd':
+            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            line = lambda row: bdd_line(row) + '\n'
+
+        else:
+            cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+            line = lambda row: json.dumps(
+                dict((column.name, row[column]) for column in sv.columns),
+                default=lambda o: str(o)) + '\n'
+
+        cherrypy.response.stream = True
+
+        return (
+            ''.join(line(row) for row in rows)
+            for rows in iter(lambda: result.fetchmany(self.chunk_size), [])
+        )
+
+    @staticmethod
+    def page():
+        """Get the task list page from the request parameters
+
+        :return: The last task ID of the previous page, the page size and the
+         seconds to wait for tasks
+        :rtype: tuple
+        """
+
+        params = cherrypy.request.params
+        limit_max = cherrypy.config.get('sync_page_max', 10000)
+        wait_max = cherrypy.config.get('sync_wait_max', 60)
+
+        try:
+            after = int(params.get('after') or 0)
+            limit = min(int(params.get('limit') or limit_max), limit_max)
+            wait = min(float(params.get('wait') or 0), wait_max)
+
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid page parameters')
+
+        if limit < 1 or wait < 0:
+            raise cherrypy.HTTPError(400, 'Invalid page parameters')
+
+        return after, limit, wait
+
+    @staticmethod
+    def json_body():
+        """Get the JSON request body
+
+        The body of methods CherryPy does not process, as DELETE, is only
+        read if the request has one, so requests without a body and a
+        Content-Length are still accepted.
+
+        :return: The decoded body or None if the request has no JSON body
+        """
+
+        request = cherrypy.request
+
+        if not request.headers.get('Content-Type', '').startswith(
+                'application/json'):
+            return None
+
+        if not request.process_request_body:
+            if 'Content-Length' not in request.headers and \
+                    'Transfer-Encoding' not in request.headers:
+                return None
+
+            request.body.process()
+
+        try:
+            return json.loads(request.body.read())
+
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid JSON request body')
+
     def GET(self, tasks=None):
         """Get Sync Tasks
 
-        :param list tasks: optional task to query
+        Without tasks, list the pending task IDs in order, one page at a
+        time: ``after`` is the last task ID of the previous page, ``limit``
+        the page size. The ``X-Sync-Next`` response header has the cursor
+        for the next page when the page is full. If the page would be empty,
+        the request waits up to ``wait`` seconds for new tasks, unless too
+        many requests are already waiting, when it is answered right away.
+
+        The response is streamed as a JSON array or, if the client accepts
+        ``application/x-ndjson``, as one JSON value per line.
+
+        With tasks, the subscription versions of the tasks still pending are
+        sent, tasks replaced by newer changes are left out.
+
+        :param list tasks: optional IDs of the tasks to query
         """
 
+        db = cherrypy.request.db
+        sync_client = cherrypy.request.sync_client
+
         if tasks:
             cherrypy.log.error('Processing tasks: {0}'
-                               .format([t.id for t in tasks]), 'SYNC', 10)
-            result = [
-                dict((k, v) for (k, v) in s.__dict__.items()
-                     if not k.startswith('_'))
-                for s in cherrypy.request.db.query(SubscriptionVersion).filter(
-                    SubscriptionVersion.id.in_([t.subscription_version_id
-                                                for t in tasks])
-                )
-            ]
+                               .format(tasks), 'SYNC', 10)
+
+            sv = SubscriptionVersion.__table__
+
+            rows = db.execute(
+                self.storage.details(sync_client, tasks)).fetchall()
+
             cherrypy.log.error('Sending subscription version list: {0}'.format(
-                [s['subscription_version_id'] for s in result]), 'SYNC', 10)
+                [row[sv.c.subscription_version_id] for row in rows]),
+                'SYNC', 10)
+
+            chunk_size = self.chunk_size
+            items = (
+                [dict((column.name, row[column]) for column in sv.columns)
+                 for row in rows[i:i + chunk_size]]
+                for i in range(0, len(rows), chunk_size)
+            )
 
         else:
-            result = [
-                t.id for t in cherrypy.request.sync_client.tasks.limit(10000)
-            ]
-            cherrypy.log.error('Sending task list: {0}'
-                               .format(result), 'SYNC', 10)
+            after, limit, wait = self.page()
+
+            query = self.storage.pending(sync_client, after)
+
+            # The semaphore is replaced on engine start
+            waiters = self.waiters
+
+            if wait and not waiters.acquire(False):
+                cherrypy.log.error('Too many waiting requests, not waiting '
+                                   'for tasks.', 'SYNC', 10)
+
+            elif wait:
+                spg_id = sync_client.service_provider_gateway_id
+                deadline = time.time() + wait
+
+                try:
+                    while True:
+                        # Read the counter before the query, so tasks
+                        # created meanwhile end the wait
+                        generation = self.generations.get(spg_id, 0)
 
-        return json.dumps(result, default=lambda o: str(o))
+                        if db.execute(query.limit(1)).scalar() is not None:
+                            break
+
+                        # Do not keep the transaction open while waiting
+                        db.commit()
+
+                        if not self.wait_tasks(spg_id, generation, deadline):
+                            break
+
+                finally:
+                    waiters.release()
+
+            # Cursor for the next page, the last task of a full page
+            cursor = db.execute(query.offset(limit - 1).limit(1)).scalar()
+
+            if cursor is not None:
+                cherrypy.response.headers['X-Sync-Next'] = str(cursor)
+                query = self.storage.pending(sync_client, after, cursor)
+
+            cherrypy.log.error('Sending task list after {0} up to {1}'
+                               .format(after, cursor), 'SYNC', 10)
+
+            result = db.execute(query.execution_options(stream_results=True))
+            items = (
+                [task_id for (task_id,) in rows]
+                for rows in iter(lambda: result.fetchmany(self.chunk_size),
+                                 [])
+            )
+
+        return self.stream(items)
+
+    chunk_size = 1000
+
+    @staticmethod
+    def stream(chunks):
+        """Stream the response items as they are produced
+
+        :param chunks: Iterable of item lists
+        :return: The response body generator
+        """
+
+        ndjson = 'application/x-ndjson' in \
+            cherrypy.request.headers.get('Accept', '')
+
+        if ndjson:
+            cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+
+        cherrypy.response.stream = True
+
+        def body():
+            separator = '['
+
+            for chunk in chunks:
+                if not chunk:
+                    continue
+
+                if ndjson:
+                    yield ''.join(json.dumps(item, default=lambda o: str(o)) +
+                                  '\n' for item in chunk)
+
+                else:
+                    yield separator + ', '.join(
+                        json.dumps(item, default=lambda o: str(o))
+                        for item in chunk)
+                    separator = ', '
+
+            if not ndjson:
+                yield '[]' if separator == '[' else ']'
+
+        return body()
 
     def DELETE(self, tasks):
         """Delete Sync Tasks
 
-        :param SyncTask tasks: task to delete
+        Tasks may also be acknowledged up to an ID, with the ``upto``
+        parameter, or on a JSON request body: either a list of task IDs or
+        an object with ``tasks`` and ``upto`` keys.
+
+        On the ``changelog`` sync mode, acknowledging a task acknowledges all
+        the previous tasks too.
+
+        Listed tasks which no longer exist, acknowledged before or replaced
+        by newer changes of their subscription versions, are ignored.
+
+        :param list tasks: IDs of the tasks to delete
         """
 
-        if not tasks:
+        body = self.json_body()
+
+        if body is None:
+            body = {}
+
+        elif isinstance(body, list):
+            body = {'tasks': body}
+
+        elif not isinstance(body, dict):
+            raise cherrypy.HTTPError(400, 'Invalid acknowledgement')
+
+        try:
+            tasks = sorted(set(tasks).union(
+                int(t) for t in body.get('tasks') or ()))
+            upto = body.get('upto', cherrypy.request.params.get('upto'))
+
+            if upto is not None:
+                upto = int(upto)
+
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, 'Invalid acknowledgement')
+
+        if not tasks and upto is None:
             raise cherrypy.HTTPError(404)
 
         # Delete task
-        cherrypy.log.error('Deleting tasks: {0}'
-                           .format([t.id for t in tasks]), 'SYNC', 10)
-        tasks.delete(synchronize_session=False)
+        cherrypy.log.error('Deleting tasks: {0} up to: {1}'
+                           .format(tasks, upto), 'SYNC', 10)
+
+        self.storage.delete(cherrypy.request.db, cherrypy.request.sync_client,
+                            tasks, upto, self.chunk_size)
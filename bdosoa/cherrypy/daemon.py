@@ -38,6 +38,20 @@ def start(cgi=False, config=None, daemon=False, debug=False,
     from bdosoa.app import App
     root_app = cherrypy.tree.mount(App)
 
+    # Error notifications plugin
+    from bdosoa.cherrypy.plugin import NotifyPlugin
+    NotifyPlugin(cherrypy.engine).subscribe()
+
+    # Routing table plugin
+    from bdosoa.cherrypy.plugin import RoutingPlugin
+    RoutingPlugin(cherrypy.engine).subscribe()
+
+    # Inbound and outbound messages plugins
+    from bdosoa.cherrypy.plugin import InboundPlugin, OutboundPlugin
+    InboundPlugin(cherrypy.engine,
+                  App.root.soap.process_xml_message).subscribe()
+    OutboundPlugin(cherrypy.engine, App.root.soap.send).subscribe()
+
     # Merge configuration files
     for c in config or []:
         cherrypy.config.update(c)
@@ -52,6 +66,19 @@ def start(cgi=False, config=None, daemon=False, debug=False,
         else:
             root_app.merge(c)
 
+    # Expired processed messages purging
+    plugins.Monitor(cherrypy.engine, App.root.soap.purge_processed_messages,
+                    frequency=cherrypy.config.get('soap_dedupe_purge_interval',
+                                                  300),
+                    name='ProcessedMessagesPurge').subscribe()
+
+    # Acknowledged sync changes truncation
+    if cherrypy.config.get('sync_mode', 'tasks') == 'changelog':
+        plugins.Monitor(cherrypy.engine, App.root.sync.truncate_changes,
+                        frequency=cherrypy.config.get(
+                            'sync_truncate_interval', 300),
+                        name='SyncChangesTruncation').subscribe()
+
     # Set CherryPy environment
     if environment is not None:
         cherrypy.config.update({'environment': environment})
@@ -3,9 +3,20 @@ CherryPy plugins
 """
 
 import cherrypy
+import threading
+
+from cherrypy.lib import httputil
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, select
 
 import bdosoa.model.meta
 
+from bdosoa.lib.notify import Notifier, TRANSPORTS
+from bdosoa.lib.routing import RoutingTable
+from bdosoa.model import (InboundMessage, OutboundMessage,
+                          ServiceProviderGateway, SubscriptionVersion)
+
 
 class SQLAlchemyPlugin(cherrypy.process.plugins.SimplePlugin):
     """The plugin is registered to the CherryPy engine and therefore
@@ -62,3 +73,530 @@ class SQLAlchemyPlugin(cherrypy.process.plugins.SimplePlugin):
         """Returns the session registry to the caller"""
 
         return self.scoped_session
+
+
+class NotifyPlugin(cherrypy.process.plugins.SimplePlugin):
+    """Mails the error reports published on the ``notify`` channel.
+
+    Reports are queued and sent by a :class:`bdosoa.lib.notify.Notifier`
+    background thread, so publishing never blocks the caller.
+    """
+
+    notifier = None
+
+    def start(self):
+        """Plugin startup routine"""
+
+        transport = cherrypy.config.get('notify_transport', 'sendmail')
+
+        if transport == 'smtp':
+            transport = TRANSPORTS[transport](
+                host=cherrypy.config.get('notify_smtp_host', 'localhost'),
+                port=cherrypy.config.get('notify_smtp_port', 25))
+
+        elif transport == 'file':
+            transport = TRANSPORTS[transport](
+                cherrypy.config.get('notify_file', 'bdosoa-notify.log'))
+
+        else:
+            transport = TRANSPORTS[transport](cherrypy.config.get(
+                'notify_sendmail_command', ['/usr/sbin/sendmail', '-t']))
+
+        self.bus.log('Starting notifier.')
+        self.notifier = Notifier(
+            transport,
+            to=cherrypy.config.get('notify_to', 'root'),
+            sender=cherrypy.config.get('notify_from'),
+            window=cherrypy.config.get('notify_window', 60),
+            max_messages=cherrypy.config.get('notify_max_messages', 10))
+        self.notifier.start()
+
+        self.bus.subscribe('notify', self.notifier.notify)
+
+    def stop(self):
+        """Plugin shutdown routine"""
+
+        if self.notifier:
+            self.bus.unsubscribe('notify', self.notifier.notify)
+
+            self.bus.log('Stopping notifier.')
+            self.notifier.stop()
+            self.notifier = None
+
+
+class RoutingPlugin(cherrypy.process.plugins.SimplePlugin):
+    """Keeps the in-memory TN routing table.
+
+    The table is loaded from the active subscription versions on startup
+    and updated by the changes published on the ``routing_update`` and
+    ``routing_delete`` channels. Lookups are published on the
+    ``routing_lookup`` channel.
+
+    The plugin is disabled by the ``routing_table`` setting.
+    """
+
+    table = None
+
+    def start(self):
+        """Plugin startup routine"""
+
+        if not cherrypy.config.get('routing_table', True):
+            return
+
+        self.table = RoutingTable(
+            cherrypy.config.get('routing_max_overlay', 10000))
+
+        self.bus.log('Loading routing table.')
+        sv = SubscriptionVersion.__table__
+        session = self.bus.publish(
+            'sqlalchemy_get_session').pop().session_factory()
+
+        try:
+            self.table.load(session.execute(
+                select([
+                    sv.c.subscription_version_tn,
+                    sv.c.subscription_version_id,
+                    sv.c.subscription_rn1,
+                    sv.c.subscription_recipient_sp,
+                    sv.c.subscription_new_cnl,
+                ]).where(and_(
+                    sv.c.subscription_deletion_timestamp.is_(None),
+                    sv.c.subscription_version_tn.isnot(None),
+                )).order_by(
+                    # Numeric TN order
+                    func.length(sv.c.subscription_version_tn),
+                    sv.c.subscription_version_tn,
+                    sv.c.subscription_version_id,
+                ).execution_options(stream_results=True)
+            ))
+
+        finally:
+            session.close()
+
+        self.bus.log('Loaded {0} routes.'.format(len(self.table.base[0])))
+
+        self.bus.subscribe('routing_update', self.table.update)
+        self.bus.subscribe('routing_delete', self.table.delete)
+        self.bus.subscribe('routing_lookup', self.table.lookup)
+
+    # Start after the SQLAlchemy plugin
+    start.priority = 70
+
+    def stop(self):
+        """Plugin shutdown routine"""
+
+        if self.table:
+            self.bus.unsubscribe('routing_update', self.table.update)
+            self.bus.unsubscribe('routing_delete', self.table.delete)
+            self.bus.unsubscribe('routing_lookup', self.table.lookup)
+            self.table = None
+
+
+@contextmanager
+def request_scope(**attributes):
+    """Run code on a CherryPy request scope outside of the HTTP server
+
+    A new request, with a database session bound like the SQLAlchemy tool
+    does, is loaded on the current thread. The session is committed on exit
+    or rolled back if an error occurs.
+
+    :param attributes: Additional request attributes
+    """
+
+    local = httputil.Host('127.0.0.1', 0, 'localhost')
+    request = cherrypy._cprequest.Request(local, local)
+    cherrypy.serving.load(request, cherrypy._cprequest.Response())
+
+    request.db = cherrypy.engine.publish('sqlalchemy_get_session').pop()
+
+    for name, value in attributes.items():
+        setattr(request, name, value)
+
+    try:
+        yield request
+        request.db.commit()
+
+    except:
+        request.db.rollback()
+        raise
+
+    finally:
+        request.db.remove()
+        cherrypy.serving.clear()
+
+
+class WorkerPlugin(cherrypy.process.plugins.SimplePlugin):
+    """Base plugin for processing queues from background worker threads.
+
+    Workers call :meth:`process` in a loop, waiting between calls for the
+    delay it returns or until they are notified on the plugin channel.
+    Subclasses must set the ``name``, ``channel`` and ``enable_setting``
+    attributes and implement :meth:`process`.
+    """
+
+    #: Plugin name, used for the worker settings
+    name = None
+
+    #: Channel notifying the workers of new queue items
+    channel = None
+
+    #: Setting enabling the plugin
+    enable_setting = None
+
+    session_factory = None
+
+    def __init__(self, bus):
+        super(WorkerPlugin, self).__init__(bus)
+
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+
+    def setting(self, name, default=None):
+        """Get a plugin setting
+
+        :param str name: Setting name, without the plugin name prefix
+        :param default: Default value
+        :return: The setting value
+        """
+
+        return cherrypy.config.get(
+            'soap_{0}_{1}'.format(self.name, name), default)
+
+    def start(self):
+        """Plugin startup routine"""
+
+        if not cherrypy.config.get(self.enable_setting, False):
+            return
+
+        self.workers = self.setting('workers', 2)
+        self.poll_interval = self.setting('poll_interval', 5)
+        self.retries = self.setting('retries', 10)
+        self.backoff = self.setting('backoff', 5)
+        self.backoff_max = self.setting('backoff_max', 3600)
+
+        self.session_factory = self.bus.publish(
+            'sqlalchemy_get_session').pop().session_factory
+
+        self.bus.log('Starting {0} {1} workers.'
+                     .format(self.workers, self.name))
+        self.running = True
+
+        for worker in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, args=(worker,),
+                name='{0}-worker-{1}'.format(self.name, worker))
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+        self.bus.subscribe(self.channel, self.notify)
+
+    # Start after the SQLAlchemy plugin
+    start.priority = 70
+
+    def stop(self):
+        """Plugin shutdown routine"""
+
+        if not self.threads:
+            return
+
+        self.bus.unsubscribe(self.channel, self.notify)
+
+        self.bus.log('Stopping {0} workers.'.format(self.name))
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    # Stop before the SQLAlchemy plugin
+    stop.priority = 30
+
+    def notify(self):
+        """Wake up the workers to process new items"""
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self, worker):
+        """Worker thread main loop
+
+        :param int worker: Worker number
+        """
+
+        while self.running:
+            try:
+                delay = self.process(worker)
+
+            except:
+                self.bus.log('Error processing {0} queue.'.format(self.name),
+                             level=40, traceback=True)
+                delay = self.poll_interval
+
+            with self.condition:
+                if self.running:
+                    self.condition.wait(delay)
+
+    def process(self, worker):
+        """Process the worker queue items
+
+        :param int worker: Worker number
+        :return: Seconds to wait before processing again
+        :rtype: float
+        """
+
+        raise NotImplementedError
+
+    def worker_gateways(self, session, model, worker):
+        """Get the gateways with pending queue items handled by a worker
+
+        Each Service Provider Gateway is always handled by the same worker,
+        keeping its items in order.
+
+        :param sqlalchemy.orm.Session session: Database session
+        :param type model: Queue model
+        :param int worker: Worker number
+        :return: List of Service Provider Gateway IDs
+        :rtype: list
+        """
+
+        return [
+            spg_id for (spg_id,) in session.query(
+                model.service_provider_gateway_id
+            ).filter_by(status='pending').distinct()
+            if spg_id % self.workers == worker
+        ]
+
+
+class OutboundPlugin(WorkerPlugin):
+    """Sends the queued outbound messages from background worker threads.
+
+    Each Service Provider Gateway messages are sent one at a time, oldest
+    first, keeping them in order. Failed deliveries are retried with
+    exponential backoff until the retry limit is reached, when the message
+    is marked as failed.
+
+    The plugin only starts the workers if the ``soap_async_output`` setting
+    is enabled.
+    """
+
+    name = 'output'
+    channel = 'outbound_notify'
+    enable_setting = 'soap_async_output'
+
+    def __init__(self, bus, send):
+        super(OutboundPlugin, self).__init__(bus)
+
+        self.send = send
+
+    def process(self, worker):
+        """Send the pending messages for the worker gateways
+
+        :param int worker: Worker number
+        :return: Seconds until the next delivery attempt is due
+        :rtype: float
+        """
+
+        delay = self.poll_interval
+        session = self.session_factory()
+
+        try:
+            for spg_id in self.worker_gateways(
+                    session, OutboundMessage, worker):
+                while self.running:
+                    message = session.query(OutboundMessage).filter_by(
+                        service_provider_gateway_id=spg_id,
+                        status='pending',
+                    ).order_by(OutboundMessage.id).first()
+
+                    if message is None:
+                        break
+
+                    if message.next_attempt is None or \
+                            message.next_attempt <= datetime.utcnow():
+                        if self.deliver(session, message):
+                            continue
+
+                    # Keep the gateway messages in order while waiting
+                    if message.status == 'pending':
+                        delay = min(delay, max(0, (
+                            message.next_attempt - datetime.utcnow()
+                        ).total_seconds()))
+                        break
+
+        finally:
+            session.close()
+
+        return delay
+
+    def deliver(self, session, message):
+        """Send a message and update the queue
+
+        :param sqlalchemy.orm.Session session: Database session
+        :param OutboundMessage message: Queued message
+        :return: True if the message was sent
+        :rtype: bool
+        """
+
+        context = '[{0}]'.format(message.header)
+
+        try:
+            self.send(message.service_provider_gateway, message.header,
+                      message.message)
+
+        except Exception as e:
+            message.attempts += 1
+            message.last_error = repr(e)
+
+            if message.attempts >= self.retries:
+                message.status = 'failed'
+                self.bus.log('{0} Giving up sending message after {1} '
+                             'attempts.'.format(context, message.attempts),
+                             level=40, traceback=True)
+
+            else:
+                message.next_attempt = datetime.utcnow() + timedelta(
+                    seconds=min(self.backoff * 2 ** (message.attempts - 1),
+                                self.backoff_max))
+                self.bus.log('{0} Error sending message, retrying at {1}.'
+                             .format(context, message.next_attempt),
+                             level=30, traceback=True)
+
+            session.commit()
+
+            return False
+
+        session.delete(message)
+        session.commit()
+
+        self.bus.log('{0} Message sent.'.format(context), level=10)
+
+        return True
+
+
+class InboundPlugin(WorkerPlugin):
+    """Processes the queued inbound messages from background worker threads.
+
+    Each Service Provider Gateway messages are processed one at a time,
+    oldest first, keeping them (and the changes to each subscription
+    version) in order. The message is removed from the queue once processed
+    and its replies sent, in a separate transaction, so a message may be
+    processed again if the worker stops in between. Messages changing the
+    subscription versions are deduplicated (see ``SOAP.dedupe_messages``)
+    and only get their recorded reply sent again, the other messages do not
+    change any data. Failed messages are retried with exponential backoff
+    until the retry limit is reached, when the message is marked as failed.
+
+    The plugin only starts the workers if the ``soap_async_input`` setting
+    is enabled.
+    """
+
+    name = 'input'
+    channel = 'inbound_notify'
+    enable_setting = 'soap_async_input'
+
+    def __init__(self, bus, receive):
+        super(InboundPlugin, self).__init__(bus)
+
+        self.receive = receive
+
+    def process(self, worker):
+        """Process the pending messages for the worker gateways
+
+        :param int worker: Worker number
+        :return: Seconds until the next processing attempt is due
+        :rtype: float
+        """
+
+        delay = self.poll_interval
+        session = self.session_factory()
+
+        try:
+            for spg_id in self.worker_gateways(
+                    session, InboundMessage, worker):
+                spg = session.query(ServiceProviderGateway).get(spg_id)
+
+                while self.running:
+                    message = session.query(InboundMessage).filter_by(
+                        service_provider_gateway_id=spg_id,
+                        status='pending',
+                    ).order_by(InboundMessage.id).first()
+
+                    if message is None:
+                        break
+
+                    if message.next_attempt is None or \
+                            message.next_attempt <= datetime.utcnow():
+                        if self.handle(session, spg.snapshot(), message):
+                            continue
+
+                    # Keep the gateway messages in order while waiting
+                    if message.status == 'pending':
+                        delay = min(delay, max(0, (
+                            message.next_attempt - datetime.utcnow()
+                        ).total_seconds()))
+                        break
+
+        finally:
+            session.close()
+
+        return delay
+
+    def handle(self, session, spg, message):
+        """Process a message and update the queue
+
+        :param sqlalchemy.orm.Session session: Database session
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param InboundMessage message: Queued message
+        :return: True if the message was processed
+        :rtype: bool
+        """
+
+        context = '[{0}]'.format(message.header)
+
+        try:
+            with request_scope(service_provider_gateway=spg) as request:
+                result = self.receive(message.header, message.message)
+
+                # Processed messages are committed by now, if the removal
+                # is lost the message is deduplicated when processed again
+                if result == '0':
+                    request.db.query(InboundMessage).filter_by(
+                        id=message.id).delete(synchronize_session=False)
+
+        except Exception as e:
+            result = repr(e)
+            self.bus.log('{0} Error processing message.'.format(context),
+                         level=40, traceback=True)
+
+        if result == '0':
+            session.expunge(message)
+            self.bus.log('{0} Message processed.'.format(context), level=10)
+
+            return True
+
+        message.attempts += 1
+        message.last_error = result
+
+        if message.attempts >= self.retries:
+            message.status = 'failed'
+            self.bus.log('{0} Giving up processing message after {1} '
+                         'attempts.'.format(context, message.attempts),
+                         level=40)
+
+        else:
+            message.next_attempt = datetime.utcnow() + timedelta(
+                seconds=min(self.backoff * 2 ** (message.attempts - 1),
+                            self.backoff_max))
+            self.bus.log('{0} Error processing message, retrying at {1}.'
+                         .format(context, message.next_attempt), level=30)
+
+        session.commit()
+
+        return False
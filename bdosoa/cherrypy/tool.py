@@ -39,6 +39,8 @@ class SQLAlchemyTool(cherrypy.Tool):
 
         cherrypy.serving.request.hooks.attach(
             'on_end_resource', self.on_end_resource, priority=80)
+        cherrypy.serving.request.hooks.attach(
+            'on_end_request', self.on_end_request, priority=80)
 
     # noinspection PyMethodMayBeStatic
     def on_start_resource(self):
@@ -50,14 +52,28 @@ class SQLAlchemyTool(cherrypy.Tool):
         req_session = cherrypy.engine.publish('sqlalchemy_get_session')
         cherrypy.serving.request.db = req_session.pop()
 
-    # noinspection PyMethodMayBeStatic
     def on_end_resource(self):
         """Commits the current transaction or rolls back
         if an error occurs. Removes the session handle
         from the requests scope.
+
+        Streamed responses read from the database while the body is
+        written, so their session is only released at the request end.
         """
 
-        if hasattr(cherrypy.serving.request, 'db'):
+        if not cherrypy.serving.response.stream:
+            self.release()
+
+    def on_end_request(self):
+        """Releases the session of streamed responses"""
+
+        self.release()
+
+    # noinspection PyMethodMayBeStatic
+    def release(self):
+        """Commits or rolls back the session and removes it"""
+
+        if getattr(cherrypy.serving.request, 'db', None) is not None:
             cherrypy.log.error('Committing session.', 'TOOLS.SQLALCHEMY', 10)
 
             try:
@@ -70,4 +86,3 @@ class SQLAlchemyTool(cherrypy.Tool):
             finally:
                 cherrypy.serving.request.db.remove()
                 cherrypy.serving.request.db = None
-
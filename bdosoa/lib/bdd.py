@@ -2,6 +2,8 @@
 BDOSOA - BDD files processing routines
 """
 
+from datetime import datetime
+
 BDD_DELIMITER = '|'
 
 BDD_HEADER = (
@@ -38,6 +40,42 @@ BDD_MAPS = {
     },
 }
 
+#: BDD codes of the subscription version values
+BDD_CODES = dict(
+    (key, dict((value, code) for code, value in value_map.items()))
+    for key, value_map in BDD_MAPS.items()
+)
+
+BDD_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+
+
+def bdd_line(sv):
+    """Format a subscription version as a BDD file line
+
+    :param sv: SubscriptionVersion instance or row
+    :return: The BDD line, without the line break
+    :rtype: unicode
+    """
+
+    fields = []
+
+    # The gateway ID is not part of the BDD files
+    for key in BDD_HEADER[:-1]:
+        value = getattr(sv, key)
+
+        if value is None:
+            value = ''
+
+        elif key in BDD_CODES:
+            value = BDD_CODES[key].get(value, '')
+
+        elif isinstance(value, datetime):
+            value = value.strftime(BDD_TIMESTAMP_FORMAT)
+
+        fields.append(unicode(value))
+
+    return BDD_DELIMITER.join(fields)
+
 
 class BDDFile(object):
     __fd__ = None
@@ -0,0 +1,108 @@
+"""
+bdosoa - in-process caches
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe LRU cache with optional entry expiration
+
+    The least recently used entries are evicted once the cache is full, by
+    number of entries or, if a byte limit is set, by the total size of the
+    values. Values larger than the byte limit are not cached.
+
+    :param int max_size: Maximum number of entries
+    :param float ttl: Entry time to live in seconds, None for no expiration
+    :param int max_bytes: Maximum total size of the values, None for no limit
+    :param sizeof: Function giving the size in bytes of a value, required
+     for the byte limit
+    """
+
+    def __init__(self, max_size=1000, ttl=None, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        """Remove all entries"""
+
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get(self, key, default=None):
+        """Get a cached value
+
+        :param key: Entry key
+        :param default: Value returned if the entry is missing or expired
+        :return: The cached value
+        """
+
+        with self.lock:
+            try:
+                value, expires, size = self.entries.pop(key)
+
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                self.bytes -= size
+                return default
+
+            # Mark as most recently used
+            self.entries[key] = (value, expires, size)
+
+            return value
+
+    def pop(self, key, default=None):
+        """Remove an entry
+
+        :param key: Entry key
+        :param default: Value returned if the entry is missing
+        :return: The removed value
+        """
+
+        with self.lock:
+            value, expires, size = self.entries.pop(key, (default, None, 0))
+            self.bytes -= size
+
+            return value
+
+    def set(self, key, value):
+        """Add or replace an entry
+
+        :param key: Entry key
+        :param value: Value
+        """
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+
+        with self.lock:
+            self.bytes -= self.entries.pop(key, (None, None, 0))[2]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, expires, size)
+            self.bytes += size
+
+            while len(self.entries) > self.max_size or (
+                    self.max_bytes is not None and
+                    self.bytes > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1][2]
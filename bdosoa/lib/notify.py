@@ -0,0 +1,256 @@
+"""
+bdosoa - error notifications
+"""
+
+import logging
+import smtplib
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from email.mime.text import MIMEText
+from subprocess import Popen, PIPE
+
+
+class SendmailTransport(object):
+    """Deliver notifications through the local sendmail command
+
+    :param list command: Sendmail command line
+    """
+
+    def __init__(self, command=('/usr/sbin/sendmail', '-t')):
+        self.command = list(command)
+
+    def send(self, mail):
+        """Send a mail message
+
+        :param email.message.Message mail: Message
+        """
+
+        p = Popen(self.command, stdin=PIPE)
+        p.communicate(mail.as_string())
+
+        if p.returncode:
+            raise RuntimeError('{0} exited with status {1}'
+                               .format(self.command[0], p.returncode))
+
+
+class SMTPTransport(object):
+    """Deliver notifications to a SMTP server
+
+    :param str host: SMTP server host
+    :param int port: SMTP server port
+    :param str sender: Envelope sender address
+    :param int timeout: Connection timeout in seconds
+    """
+
+    def __init__(self, host='localhost', port=25, sender='bdosoa@localhost',
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    def send(self, mail):
+        """Send a mail message
+
+        :param email.message.Message mail: Message
+        """
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            smtp.sendmail(mail['From'] or self.sender,
+                          [a.strip() for a in mail['To'].split(',')],
+                          mail.as_string())
+
+        finally:
+            smtp.quit()
+
+
+class FileTransport(object):
+    """Append notifications to a local file
+
+    :param str path: File path
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, mail):
+        """Send a mail message
+
+        :param email.message.Message mail: Message
+        """
+
+        with open(self.path, 'a') as f:
+            f.write(mail.as_string())
+            f.write('\n\n')
+
+
+#: Available transports by name
+TRANSPORTS = {
+    'file': FileTransport,
+    'sendmail': SendmailTransport,
+    'smtp': SMTPTransport,
+}
+
+
+class Notifier(object):
+    """Queue error reports and mail them from a background thread
+
+    Identical reports (same key, e.g. the Service Provider Gateway and the
+    traceback) received within the aggregation window are grouped into one
+    digest listing every occurrence. At most ``max_messages`` mails are
+    sent per window, the remaining reports are summarized on a last mail.
+
+    :param transport: Transport used to deliver the mails
+    :param str to: Recipient addresses
+    :param str sender: Sender address
+    :param float window: Aggregation window in seconds
+    :param int max_messages: Maximum mails sent per window
+    :param int max_occurrences: Maximum occurrences listed on a digest
+    """
+
+    def __init__(self, transport, to='root', sender=None, window=60,
+                 max_messages=10, max_occurrences=50):
+        self.logger = logging.getLogger(
+            '.'.join([__name__, self.__class__.__name__]))
+
+        self.transport = transport
+        self.to = to
+        self.sender = sender
+        self.window = window
+        self.max_messages = max_messages
+        self.max_occurrences = max_occurrences
+
+        self.condition = threading.Condition()
+        self.reports = OrderedDict()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start the delivery thread"""
+
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name='notifier')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the delivery thread, sending the pending reports"""
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def notify(self, key, subject, body, detail=''):
+        """Queue an error report
+
+        This never blocks on the mail delivery.
+
+        :param key: Grouping key, reports with the same key are aggregated
+        :param str subject: Mail subject
+        :param str body: Report body, usually the traceback
+        :param str detail: Occurrence detail, e.g. the message invoke ID
+        """
+
+        occurrence = (datetime.now(), detail)
+
+        with self.condition:
+            report = self.reports.get(key)
+
+            if report is None:
+                self.reports[key] = {
+                    'subject': subject,
+                    'body': body,
+                    'count': 1,
+                    'occurrences': [occurrence],
+                }
+
+            else:
+                report['count'] += 1
+
+                if len(report['occurrences']) < self.max_occurrences:
+                    report['occurrences'].append(occurrence)
+
+    def run(self):
+        """Delivery thread main loop"""
+
+        while True:
+            deadline = time.time() + self.window
+
+            with self.condition:
+                while self.running and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+
+                running = self.running
+                reports = self.reports
+                self.reports = OrderedDict()
+
+            if reports:
+                self.flush(reports.values())
+
+            if not running:
+                break
+
+    def flush(self, reports):
+        """Send the aggregated reports
+
+        :param list reports: Reports to send
+        """
+
+        reports = list(reports)
+
+        for report in reports[:self.max_messages]:
+            subject = report['subject']
+
+            if report['count'] > 1:
+                subject = '{0} ({1} occurrences)'.format(
+                    subject, report['count'])
+
+            lines = ['{0:%Y-%m-%d %H:%M:%S} {1}'.format(*occurrence)
+                     for occurrence in report['occurrences']]
+
+            if report['count'] > len(lines):
+                lines.append('... {0} more'.format(
+                    report['count'] - len(lines)))
+
+            self.send(subject, '{0}\n\n{1}\n'.format(
+                report['body'], '\n'.join(lines)))
+
+        # Rate limited reports
+        dropped = reports[self.max_messages:]
+
+        if dropped:
+            self.send(
+                'BDOSOA - {0} more error reports suppressed'
+                .format(len(dropped)),
+                '\n'.join('{0[count]:6d} {0[subject]}'.format(report)
+                          for report in dropped) + '\n')
+
+    def send(self, subject, body):
+        """Send a mail through the transport
+
+        :param str subject: Mail subject
+        :param str body: Mail body
+        """
+
+        mail = MIMEText(body)
+        mail['To'] = self.to
+        mail['Subject'] = subject
+
+        if self.sender:
+            mail['From'] = self.sender
+
+        try:
+            self.transport.send(mail)
+
+        except Exception:
+            self.logger.exception('Error sending notification.')
@@ -0,0 +1,386 @@
+"""
+bdosoa - SPG query expressions compiler
+"""
+
+import re
+
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, and_, not_, null, or_
+
+from bdosoa.lib.cache import LRUCache
+
+
+Token = namedtuple('Token', ['type', 'value'])
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<number>-?\d+)(?![\w.])
+      | (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+      | (?P<operator><>|!=|==|<=|>=|&&|\|\||[=<>!(),])
+      | (?P<name>[A-Za-z_][\w.]*)
+    )
+''', re.VERBOSE)
+
+KEYWORDS = frozenset(
+    ['AND', 'BETWEEN', 'IN', 'IS', 'LIKE', 'NOT', 'NULL', 'OR'])
+
+# Operator aliases
+OPERATORS = {
+    '!': 'NOT',
+    '!=': '<>',
+    '&&': 'AND',
+    '==': '=',
+    '||': 'OR',
+}
+
+COMPARISONS = {
+    '=': lambda c, v: c == v,
+    '<>': lambda c, v: c != v,
+    '<': lambda c, v: c < v,
+    '<=': lambda c, v: c <= v,
+    '>': lambda c, v: c > v,
+    '>=': lambda c, v: c >= v,
+}
+
+DATETIME_FORMATS = (
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y%m%d%H%M%S',
+    '%Y-%m-%d',
+    '%Y%m%d',
+)
+
+
+def unquote(expression):
+    """Remove the double quotes some gateways send around the expression
+
+    :param str expression: Query expression
+    :return: The unquoted expression
+    :rtype: str
+    """
+
+    if expression.startswith('"') and expression.endswith('"'):
+        expression = expression.lstrip('" ').rstrip(' "')
+
+    return expression
+
+
+def tokenize(expression):
+    """Split a query expression into tokens
+
+    Keywords and operators are normalized to their upper case SQL form.
+
+    :param str expression: Query expression
+    :return: List of tokens
+    :rtype: list
+    :raises ValueError: If the expression has invalid characters
+    """
+
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+
+        if match is None:
+            raise ValueError('Invalid query expression at position {0}: {1}'
+                             .format(position, expression[position:]))
+
+        position = match.end()
+        token_type = match.lastgroup
+        value = match.group(token_type)
+
+        if token_type == 'number':
+            value = int(value)
+
+        elif token_type == 'string':
+            value = value[1:-1].replace(value[0] * 2, value[0])
+
+        elif token_type == 'operator':
+            value = OPERATORS.get(value, value)
+
+            if value in KEYWORDS:
+                token_type = 'keyword'
+
+        elif value.upper() in KEYWORDS:
+            token_type = 'keyword'
+            value = value.upper()
+
+        else:
+            value = value.lower()
+
+        tokens.append(Token(token_type, value))
+
+    return tokens
+
+
+def normalize(tokens):
+    """Build the normalized form of a tokenized query expression
+
+    Expressions differing only on whitespace, keyword case, quoting or
+    operator aliases have the same normalized form.
+
+    :param list tokens: Query expression tokens
+    :return: The normalized expression
+    :rtype: str
+    """
+
+    return ' '.join(
+        "'{0}'".format(token.value.replace("'", "''"))
+        if token.type == 'string' else unicode(token.value)
+        for token in tokens
+    )
+
+
+class Parser(object):
+    """Parse query expressions into SQLAlchemy expressions
+
+    Grammar::
+
+        expression := term (OR term)*
+        term       := factor (AND factor)*
+        factor     := NOT factor | '(' expression ')' | predicate
+        predicate  := column comparison value
+                    | column [NOT] LIKE value
+                    | column [NOT] IN '(' value (',' value)* ')'
+                    | column [NOT] BETWEEN value AND value
+                    | column IS [NOT] NULL
+
+    :param dict columns: Columns allowed on the expressions by name
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+        self.tokens = []
+        self.position = 0
+
+    def parse(self, tokens):
+        """Parse a tokenized query expression
+
+        :param list tokens: Query expression tokens
+        :return: The expression criterion
+        :raises ValueError: If the expression is invalid
+        """
+
+        if not tokens:
+            raise ValueError('A query expression must be specified')
+
+        self.tokens = tokens
+        self.position = 0
+
+        criterion = self.expression()
+
+        if self.position < len(self.tokens):
+            raise ValueError('Unexpected {0!r} on query expression'
+                             .format(self.tokens[self.position].value))
+
+        return criterion
+
+    def peek(self, *values):
+        """Check if the next token is a keyword or operator
+
+        :param values: Accepted token values
+        :return: True if the next token is one of the values
+        :rtype: bool
+        """
+
+        return self.position < len(self.tokens) and \
+            self.tokens[self.position].type in ('keyword', 'operator') and \
+            self.tokens[self.position].value in values
+
+    def accept(self, *values):
+        """Consume the next token if it is a keyword or operator
+
+        :param values: Accepted token values
+        :return: The consumed token value or None
+        """
+
+        if self.peek(*values):
+            self.position += 1
+            return self.tokens[self.position - 1].value
+
+    def expect(self, *values):
+        """Consume the next token, which must be a keyword or operator
+
+        :param values: Accepted token values
+        :return: The consumed token value
+        :raises ValueError: If the next token is not one of the values
+        """
+
+        value = self.accept(*values)
+
+        if value is None:
+            raise ValueError('Expected {0} on query expression'
+                             .format(' or '.join(values)))
+
+        return value
+
+    def next(self, *types):
+        """Consume the next token, which must be of one of the types
+
+        :param types: Accepted token types
+        :return: The consumed token value
+        :raises ValueError: If the expression ended or the type differs
+        """
+
+        if self.position >= len(self.tokens):
+            raise ValueError('Unexpected end of query expression')
+
+        token = self.tokens[self.position]
+
+        if token.type not in types:
+            raise ValueError('Unexpected {0!r} on query expression'
+                             .format(token.value))
+
+        self.position += 1
+        return token.value
+
+    def expression(self):
+        criteria = [self.term()]
+
+        while self.accept('OR'):
+            criteria.append(self.term())
+
+        return or_(*criteria) if len(criteria) > 1 else criteria[0]
+
+    def term(self):
+        criteria = [self.factor()]
+
+        while self.accept('AND'):
+            criteria.append(self.factor())
+
+        return and_(*criteria) if len(criteria) > 1 else criteria[0]
+
+    def factor(self):
+        if self.accept('NOT'):
+            return not_(self.factor())
+
+        if self.accept('('):
+            criterion = self.expression()
+            self.expect(')')
+            return criterion
+
+        return self.predicate()
+
+    def predicate(self):
+        name = self.next('name')
+
+        # Allow the table name prefix
+        column = self.columns.get(name.rsplit('.', 1)[-1])
+
+        if column is None:
+            raise ValueError('Invalid query expression field: {0}'
+                             .format(name))
+
+        if self.accept('IS'):
+            if self.accept('NOT'):
+                self.expect('NULL')
+                return column.isnot(null())
+
+            self.expect('NULL')
+            return column.is_(null())
+
+        operator = self.accept(*COMPARISONS)
+
+        if operator:
+            return COMPARISONS[operator](column, self.value(column))
+
+        negate = self.accept('NOT')
+        operator = self.expect('LIKE', 'IN', 'BETWEEN')
+
+        if operator == 'LIKE':
+            criterion = column.like(self.value(column, like=True))
+
+        elif operator == 'IN':
+            self.expect('(')
+            values = [self.value(column)]
+
+            while self.accept(','):
+                values.append(self.value(column))
+
+            self.expect(')')
+            criterion = column.in_(values)
+
+        else:
+            low = self.value(column)
+            self.expect('AND')
+            criterion = column.between(low, self.value(column))
+
+        return not_(criterion) if negate else criterion
+
+    def value(self, column, like=False):
+        """Consume a literal value converted to the column type
+
+        :param column: Column compared to the value
+        :param bool like: If the value is a LIKE pattern
+        :return: The converted value
+        :raises ValueError: If the value is invalid for the column
+        """
+
+        value = self.next('string', 'number')
+
+        if like:
+            return unicode(value)
+
+        if isinstance(column.type, Integer):
+            try:
+                return int(value)
+
+            except ValueError:
+                raise ValueError('Invalid integer value for {0}: {1!r}'
+                                 .format(column.name, value))
+
+        if isinstance(column.type, DateTime):
+            for datetime_format in DATETIME_FORMATS:
+                try:
+                    return datetime.strptime(unicode(value), datetime_format)
+
+                except ValueError:
+                    pass
+
+            raise ValueError('Invalid date and time value for {0}: {1!r}'
+                             .format(column.name, value))
+
+        return unicode(value)
+
+
+class QueryCompiler(object):
+    """Compile query expressions into statements, caching the results
+
+    Compiled statements are cached by the normalized expression, so repeated
+    queries skip the parsing.
+
+    :param dict columns: Columns allowed on the expressions by name
+    :param callable build: Called with the expression criterion to build
+     the statement
+    :param int cache_size: Maximum number of cached statements
+    """
+
+    def __init__(self, columns, build, cache_size=256):
+        self.columns = columns
+        self.build = build
+        self.cache = LRUCache(cache_size)
+
+    def compile(self, expression):
+        """Get the statement for a query expression
+
+        :param str expression: Query expression
+        :return: The normalized expression and the statement
+        :rtype: tuple
+        :raises ValueError: If the expression is invalid
+        """
+
+        tokens = tokenize(expression)
+        key = normalize(tokens)
+
+        statement = self.cache.get(key)
+
+        if statement is None:
+            statement = self.build(Parser(self.columns).parse(tokens))
+            self.cache.set(key, statement)
+
+        return key, statement
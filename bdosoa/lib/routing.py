@@ -0,0 +1,275 @@
+"""
+bdosoa - in-memory TN routing table
+"""
+
+import threading
+
+from array import array
+from bisect import bisect_left
+
+#: Route index of removed TNs
+REMOVED = 0
+
+
+class RoutingTable(object):
+    """Compact map of TNs to their active route (RN1, recipient SP and CNL)
+
+    The bulk of the entries is kept on sorted arrays: the TNs, the version
+    IDs and an index on the table of distinct routes, about 20 bytes per TN
+    on 64 bit platforms. Incremental changes go to an overlay dictionary,
+    merged into new arrays once it reaches ``max_overlay`` entries.
+
+    For each TN only the route of the highest subscription version ID is
+    kept, so changes may be applied in any order. Removed TNs keep their
+    version ID, with the ``REMOVED`` route, so older changes received later
+    are still ignored.
+
+    Lookups are lock free, the arrays are replaced and never changed.
+
+    :param int max_overlay: Maximum number of changes kept on the overlay
+    """
+
+    def __init__(self, max_overlay=10000):
+        self.max_overlay = max_overlay
+
+        self.lock = threading.Lock()
+
+        self.base = (array('L'), array('l'), array('I'))
+        self.overlay = {}
+
+        self.routes = [None]
+        self.route_ids = {}
+
+    @staticmethod
+    def tn_key(tn):
+        """Get the numeric key of a TN
+
+        :param str tn: TN
+        :return: The TN key or None if it is not numeric
+        :rtype: long
+        """
+
+        try:
+            return long(tn)
+
+        except (TypeError, ValueError):
+            return None
+
+    def route_id(self, rn1, recipient_sp, cnl):
+        """Get the index of a route on the routes table, adding it if missing
+
+        Must be called with the lock held.
+
+        :param str rn1: RN1
+        :param str recipient_sp: Recipient service provider ID
+        :param str cnl: CNL
+        :return: The route index
+        :rtype: int
+        """
+
+        route = (rn1, recipient_sp, cnl)
+        route_id = self.route_ids.get(route)
+
+        if route_id is None:
+            route_id = self.route_ids[route] = len(self.routes)
+            self.routes.append(route)
+
+        return route_id
+
+    def find(self, key):
+        """Find a TN on the base arrays
+
+        :param long key: TN key
+        :return: The version ID and route index or None
+        :rtype: tuple
+        """
+
+        tns, versions, route_ids = self.base
+        i = bisect_left(tns, key)
+
+        if i < len(tns) and tns[i] == key:
+            return versions[i], route_ids[i]
+
+    def entry(self, key):
+        """Get the current version ID and route index of a TN
+
+        :param long key: TN key
+        :return: The version ID and route index (``REMOVED`` for removed
+         TNs) or None if the TN is unknown
+        :rtype: tuple
+        """
+
+        entry = self.overlay.get(key)
+
+        if entry is None:
+            entry = self.find(key)
+
+        return entry
+
+    def load(self, rows):
+        """Replace the table contents
+
+        :param rows: Iterable of (TN, version ID, RN1, recipient SP, CNL)
+         tuples, preferably sorted by TN and version ID
+        """
+
+        tns, versions, route_ids = array('L'), array('l'), array('I')
+        overlay = {}
+
+        with self.lock:
+            self.routes = [None]
+            self.route_ids = {}
+
+            for tn, version_id, rn1, recipient_sp, cnl in rows:
+                key = self.tn_key(tn)
+
+                if key is None:
+                    continue
+
+                route_id = self.route_id(rn1, recipient_sp, cnl)
+
+                # Keep only the highest version of each TN
+                if tns and tns[-1] == key:
+                    if versions[-1] <= version_id:
+                        versions[-1] = version_id
+                        route_ids[-1] = route_id
+
+                elif not tns or tns[-1] < key:
+                    tns.append(key)
+                    versions.append(version_id)
+                    route_ids.append(route_id)
+
+                # Unsorted rows are merged at the end
+                elif key not in overlay or overlay[key][0] <= version_id:
+                    overlay[key] = (version_id, route_id)
+
+            self.base = (tns, versions, route_ids)
+            self.overlay = overlay
+
+            self.compact(force=True)
+
+    def update(self, tn, version_id, rn1, recipient_sp, cnl):
+        """Set the route of a TN
+
+        The route is ignored if the TN has a higher version or the same
+        version was removed.
+
+        :param str tn: TN
+        :param int version_id: Subscription version ID
+        :param str rn1: RN1
+        :param str recipient_sp: Recipient service provider ID
+        :param str cnl: CNL
+        """
+
+        key = self.tn_key(tn)
+
+        if key is None:
+            return
+
+        with self.lock:
+            entry = self.entry(key)
+
+            if entry is None or entry[0] < version_id or (
+                    entry[0] == version_id and entry[1] != REMOVED):
+                self.overlay[key] = (
+                    version_id, self.route_id(rn1, recipient_sp, cnl))
+
+                self.compact()
+
+    def delete(self, tn, version_id):
+        """Remove the route of a TN
+
+        The route is ignored if the TN has a higher version.
+
+        :param str tn: TN
+        :param int version_id: Subscription version ID
+        """
+
+        key = self.tn_key(tn)
+
+        if key is None:
+            return
+
+        with self.lock:
+            entry = self.entry(key)
+
+            if entry is None or entry[0] <= version_id:
+                self.overlay[key] = (version_id, REMOVED)
+
+                self.compact()
+
+    def compact(self, force=False):
+        """Merge the overlay into the arrays once it is full
+
+        Must be called with the lock held.
+
+        :param bool force: Merge the overlay even if it is not full
+        """
+
+        if not self.overlay or \
+                (len(self.overlay) < self.max_overlay and not force):
+            return
+
+        tns, versions, route_ids = self.base
+        new_tns, new_versions, new_route_ids = \
+            array('L'), array('l'), array('I')
+
+        changes = sorted(self.overlay.items())
+        i = 0
+
+        for key, (version_id, route_id) in changes:
+            j = bisect_left(tns, key, i)
+
+            new_tns.extend(tns[i:j])
+            new_versions.extend(versions[i:j])
+            new_route_ids.extend(route_ids[i:j])
+
+            i = j
+
+            if j < len(tns) and tns[j] == key:
+                # Keep the base entry if it has a higher version
+                if versions[j] > version_id:
+                    continue
+
+                # Skip the replaced entry
+                i += 1
+
+            new_tns.append(key)
+            new_versions.append(version_id)
+            new_route_ids.append(route_id)
+
+        new_tns.extend(tns[i:])
+        new_versions.extend(versions[i:])
+        new_route_ids.extend(route_ids[i:])
+
+        self.base = (new_tns, new_versions, new_route_ids)
+        self.overlay = {}
+
+    def lookup(self, tns):
+        """Get the routes of TNs
+
+        :param list tns: TNs
+        :return: Dictionary of routes by TN, None for TNs without route
+        :rtype: dict
+        """
+
+        result = {}
+        routes = self.routes
+
+        for tn in tns:
+            key = self.tn_key(tn)
+            entry = self.entry(key) if key is not None else None
+
+            if entry is None or entry[1] == REMOVED:
+                result[tn] = None
+
+            else:
+                rn1, recipient_sp, cnl = routes[entry[1]]
+                result[tn] = {
+                    'version_id': entry[0],
+                    'rn1': rn1,
+                    'recipient_sp': recipient_sp,
+                    'cnl': cnl,
+                }
+
+        return result
@@ -0,0 +1,143 @@
+"""
+bdosoa - keyed work scheduler
+"""
+
+import Queue
+import threading
+
+
+class Task(object):
+    """Work item scheduled on a lane
+
+    :param callable func: Function to run
+    :param tuple args: Function arguments
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __call__(self):
+        try:
+            self.result = self.func(*self.args)
+
+        except Exception as e:
+            self.error = e
+
+        finally:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the task to finish
+
+        :param float timeout: Maximum seconds to wait, None to wait forever
+        :return: The function result
+        :raises RuntimeError: If the task did not finish in time
+        :raises Exception: The error raised by the function
+        """
+
+        if not self.done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the task to finish')
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class LaneScheduler(object):
+    """Run work on a fixed set of lanes, one thread per lane
+
+    Work is assigned to a lane by the hash of its key, so work items with
+    the same key run one at a time in submission order while items with
+    different keys may run in parallel.
+
+    :param int lanes: Number of lanes
+    :param str name: Name prefix of the lane threads
+    """
+
+    def __init__(self, lanes=4, name='lane'):
+        self.name = name
+        self.queues = [Queue.Queue() for _ in range(lanes)]
+        self.processed = [0] * lanes
+        self.threads = []
+
+    def __len__(self):
+        return len(self.queues)
+
+    def start(self):
+        """Start the lane threads"""
+
+        for lane, queue in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self.run, args=(lane, queue),
+                name='{0}-{1}'.format(self.name, lane))
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the lane threads after the queued work is done"""
+
+        for queue in self.queues:
+            queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def run(self, lane, queue):
+        """Lane thread main loop
+
+        :param int lane: Lane number
+        :param Queue.Queue queue: Lane queue
+        """
+
+        while True:
+            task = queue.get()
+
+            if task is None:
+                break
+
+            task()
+            self.processed[lane] += 1
+
+    def lane(self, key):
+        """Get the lane for a key
+
+        :param key: Hashable work key
+        :return: The lane number
+        :rtype: int
+        """
+
+        return hash(key) % len(self.queues)
+
+    def submit(self, key, func, *args):
+        """Schedule work on the lane of a key
+
+        :param key: Hashable work key
+        :param callable func: Function to run
+        :param args: Function arguments
+        :return: The scheduled task
+        :rtype: Task
+        """
+
+        task = Task(func, args)
+        self.queues[self.lane(key)].put(task)
+
+        return task
+
+    def depths(self):
+        """Get the number of queued work items per lane
+
+        :return: Queue depth by lane
+        :rtype: list
+        """
+
+        return [queue.qsize() for queue in self.queues]
@@ -2,11 +2,18 @@
 bdosoa - SOAP processing routines
 """
 
+import errno
+import httplib
 import logging
-import urllib2
+import select
+import socket
+import threading
+import time
+import urlparse
 
 from lxml import etree
 from lxml.builder import ElementMaker
+from xml.sax.saxutils import escape
 
 
 #
@@ -41,10 +48,10 @@ class ElementBase(etree.ElementBase):
             string = string.encode('utf-8')
 
         # Parse the XML string
-        return etree.fromstring(string, parser=XMLParser)
+        return etree.fromstring(string, parser=XMLParsers.parser)
 
     @staticmethod
-    def to_string(element):
+    def to_string(element, pretty_print=True):
         if callable(element):
             element = element()
 
@@ -52,24 +59,60 @@ class ElementBase(etree.ElementBase):
             element,
             encoding='utf-8',
             xml_declaration=True,
-            pretty_print=True,
+            pretty_print=pretty_print,
         )
 
 XMLParserLookup = etree.ElementNamespaceClassLookup(
     fallback=etree.ElementDefaultClassLookup(element=ElementBase))
 
-XMLParser = etree.XMLParser(encoding='utf-8', no_network=False)
-XMLParser.set_element_class_lookup(XMLParserLookup)
+
+class XMLParserPool(threading.local):
+    """Per-thread XML parsers
+
+    lxml parsers must not be shared between threads, so each thread gets its
+    own parser (with the same options and element class lookup) on first use.
+
+    :param lookup: Element class lookup
+    :param options: XML parser options
+    """
+
+    def __init__(self, lookup, **options):
+        self.lookup = lookup
+        self.options = options
+        self.parser = self.new_parser()
+
+    def new_parser(self, parser_class=etree.XMLParser, **kwargs):
+        """Create a new parser with the pool options and class lookup
+
+        :param type parser_class: Parser class
+        :param kwargs: Additional parser options
+        :return: A new parser
+        """
+
+        options = dict(self.options)
+        options.update(kwargs)
+
+        parser = parser_class(**options)
+        parser.set_element_class_lookup(self.lookup)
+
+        return parser
+
+    def makeelement(self, *args, **kwargs):
+        """Create a new element using the current thread parser"""
+
+        return self.parser.makeelement(*args, **kwargs)
+
+XMLParsers = XMLParserPool(XMLParserLookup, encoding='utf-8', no_network=False)
 
 E = ElementMaker(
     nsmap=SOAP_NSMAP,
-    makeelement=XMLParser.makeelement,
+    makeelement=XMLParsers.makeelement,
 )
 
 S = ElementMaker(
     namespace=SOAP_ENV_URI,
     nsmap=SOAP_NSMAP,
-    makeelement=XMLParser.makeelement,
+    makeelement=XMLParsers.makeelement,
 )
 
 
@@ -156,19 +199,37 @@ class SOAPException(Exception):
 class SOAPApplication(object):
     """SOAP application
 
+    Single method responses are rendered from pre-serialized templates and
+    short results (usually status codes) are cached, avoiding building and
+    serializing a new tree for every request.
+
     :param str namespace: Default namespace URI for registering methods
+    :param bool pretty_print: Pretty print the responses
     """
 
     __methods__ = {}
     __namespace__ = ''
 
-    def __init__(self, namespace=None):
+    #: Marker replaced by the method result on response templates
+    __result_marker__ = '@@SOAPResult@@'
+
+    #: Maximum result length and number of cached responses
+    __cache_result_length__ = 32
+    __cache_size__ = 256
+
+    def __init__(self, namespace=None, pretty_print=True):
         self.logger = logging.getLogger(
             '.'.join([__name__, self.__class__.__name__]))
 
         if namespace is not None:
             self.__namespace__ = namespace
 
+        self.pretty_print = pretty_print
+
+        self.__faults__ = {}
+        self.__responses__ = {}
+        self.__templates__ = {}
+
     def process_request(self, request):
         """Process SOAP requests
 
@@ -183,43 +244,212 @@ class SOAPApplication(object):
             # Deserialize the request
             soap_request = ElementBase.from_string(request)
 
-            # Initialize the response
-            soap_response = S.Envelope(S.Body())
+            results = [(method_call.tag, self.call_method(method_call))
+                       for method_call in soap_request.body]
 
-            for method_call in soap_request.body:
+            # Serialize the response
+            response_body = self.render_response(results)
+            response_code = 200
 
-                method = self.__methods__.get(method_call.tag)
+        except:
+            self.logger.exception('Error processing SOAP request.')
+            response_body = self.render_fault()
+            response_code = 500
 
-                if method is None:
-                    raise NotImplementedError(
-                        'Method not implemented: {0}'.format(method_call.tag))
+        self.logger.debug('Request response:\n({0})\n{1}'.format(
+            response_code, response_body))
 
-                params = dict((QName(arg).localname, arg.text)
-                              for arg in method_call)
+        return response_code, response_body
 
-                result = method(**params)
+    def process_stream(self, stream, chunk_size=65536):
+        """Process SOAP requests incrementally
 
-                soap_response.body.append(
-                    E(method_call.tag + 'Response',
-                      E(method_call.tag + 'Result', result))
-                )
+        The request is fed to the parser in chunks and each method call is
+        dispatched as soon as it is complete, being discarded right after.
+        Memory usage is bound to a single method call instead of the whole
+        envelope.
 
-        except:
-            soap_response = S.Envelope(S.Body(
-                S.Fault(
-                    E.faultcode(':'.join([SOAP_ENV_NS, 'Server'])),
-                    E.faultstring('Error processing the request')
-                )
-            ))
+        :param stream: File-like object with the XML document
+        :param int chunk_size: Number of bytes read from the stream at once
+        :return: A tuple consisting in the response code and the response body
+        :rtype: tuple
+        """
+
+        body_tag = QName(SOAP_ENV_URI, 'Body').text
+
+        try:
+            parser = XMLParsers.new_parser(
+                etree.XMLPullParser, events=('start', 'end'))
+
+            results = []
+
+            # Depth relative to the SOAP body, zero while outside of it
+            depth = 0
+
+            for chunk in iter(lambda: stream.read(chunk_size), ''):
+                parser.feed(chunk)
+
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        if depth or element.tag == body_tag:
+                            depth += 1
+
+                        continue
+
+                    if not depth:
+                        continue
+
+                    depth -= 1
+
+                    # Method call completely parsed
+                    if depth == 1:
+                        self.logger.debug('Received SOAP method call:\n{0}'
+                                          .format(str(element)))
+
+                        results.append(
+                            (element.tag, self.call_method(element)))
+
+                        # Discard the processed method call
+                        element.clear()
+                        element.getparent().remove(element)
+
+            parser.close()
 
-        # Serialize the response
-        response_body = str(soap_response)
+            # Serialize the response
+            response_body = self.render_response(results)
+            response_code = 200
+
+        except:
+            self.logger.exception('Error processing SOAP request.')
+            response_body = self.render_fault()
+            response_code = 500
 
         self.logger.debug('Request response:\n({0})\n{1}'.format(
             response_code, response_body))
 
         return response_code, response_body
 
+    def call_method(self, method_call):
+        """Call the application method for a SOAP method call element
+
+        :param ElementBase method_call: Method call element
+        :return: The method result
+        :rtype: str
+        """
+
+        method = self.__methods__.get(method_call.tag)
+
+        if method is None:
+            raise NotImplementedError(
+                'Method not implemented: {0}'.format(method_call.tag))
+
+        params = dict((QName(arg).localname, arg.text)
+                      for arg in method_call)
+
+        return method(**params)
+
+    @staticmethod
+    def method_response(tag, result):
+        """Build a SOAP method response element
+
+        :param str tag: Method call tag
+        :param str result: Method result
+        :return: The method response element
+        :rtype: ElementBase
+        """
+
+        return E(tag + 'Response', E(tag + 'Result', result))
+
+    def render_response(self, results):
+        """Serialize the SOAP response for the method results
+
+        :param list results: List of (method call tag, result) tuples
+        :return: The serialized SOAP envelope
+        :rtype: str
+        """
+
+        if len(results) == 1:
+            return self.render_result(*results[0])
+
+        return ElementBase.to_string(
+            S.Envelope(S.Body(*[self.method_response(tag, result)
+                                for tag, result in results])),
+            pretty_print=self.pretty_print,
+        )
+
+    def render_result(self, tag, result):
+        """Serialize a single method SOAP response using a template
+
+        :param str tag: Method call tag
+        :param str result: Method result
+        :return: The serialized SOAP envelope
+        :rtype: str
+        """
+
+        key = (tag, result, self.pretty_print)
+        response = self.__responses__.get(key)
+
+        if response is None:
+            prefix, suffix = self.template(tag)
+
+            if isinstance(result, unicode):
+                result = result.encode('utf-8')
+
+            response = prefix + escape(result) + suffix
+
+            # Cache constant responses (status codes)
+            if len(result) <= self.__cache_result_length__ and \
+                    len(self.__responses__) < self.__cache_size__:
+                self.__responses__[key] = response
+
+        return response
+
+    def render_fault(self):
+        """Serialize the SOAP fault response
+
+        :return: The serialized SOAP envelope
+        :rtype: str
+        """
+
+        response = self.__faults__.get(self.pretty_print)
+
+        if response is None:
+            response = ElementBase.to_string(
+                S.Envelope(S.Body(
+                    S.Fault(
+                        E.faultcode(':'.join([SOAP_ENV_NS, 'Server'])),
+                        E.faultstring('Error processing the request')
+                    )
+                )),
+                pretty_print=self.pretty_print,
+            )
+
+            self.__faults__[self.pretty_print] = response
+
+        return response
+
+    def template(self, tag):
+        """Get the pre-serialized response template for a method
+
+        :param str tag: Method call tag
+        :return: The serialized envelope parts before and after the result
+        :rtype: tuple
+        """
+
+        key = (tag, self.pretty_print)
+        template = self.__templates__.get(key)
+
+        if template is None:
+            template = tuple(ElementBase.to_string(
+                S.Envelope(S.Body(
+                    self.method_response(tag, self.__result_marker__))),
+                pretty_print=self.pretty_print,
+            ).split(self.__result_marker__))
+
+            self.__templates__[key] = template
+
+        return template
+
     def register_method(self, name, func):
         """Register application method
 
@@ -233,20 +463,251 @@ class SOAPApplication(object):
         self.__methods__[name] = func
 
 
+class HTTPConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections to a single URL
+
+    Idle connections are kept open for reuse and checked before being
+    handed out again. Connections idle for more than the idle timeout, or
+    closed by the server, are discarded.
+
+    :param str url: Request URL
+    :param int size: Maximum number of idle connections kept open
+    :param float idle_timeout: Seconds an idle connection is kept open
+    :param float timeout: Socket timeout in seconds
+    """
+
+    def __init__(self, url, size=4, idle_timeout=60, timeout=30):
+        self.logger = logging.getLogger(
+            '.'.join([__name__, self.__class__.__name__]))
+
+        url = urlparse.urlsplit(url)
+
+        if url.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+
+        self.host = url.hostname
+        self.port = url.port
+        self.path = urlparse.urlunsplit(('', '', url.path or '/', url.query, ''))
+
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def close(self):
+        """Close all idle connections"""
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for connection, last_used in idle:
+            connection.close()
+
+    def get(self):
+        """Get a healthy idle connection or open a new one
+
+        :return: A tuple consisting in the connection and whether it is
+         being reused
+        :rtype: tuple
+        """
+
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+
+                connection, last_used = self.idle.pop()
+
+            if time.time() - last_used < self.idle_timeout and \
+                    self.is_healthy(connection):
+                return connection, True
+
+            self.logger.debug('Discarding idle connection to {0}:{1}'
+                              .format(self.host, self.port))
+            connection.close()
+
+        self.logger.debug('Opening new connection to {0}:{1}'
+                          .format(self.host, self.port))
+
+        return self.connection_class(
+            self.host, self.port, timeout=self.timeout), False
+
+    def put(self, connection):
+        """Return a connection to the pool
+
+        :param httplib.HTTPConnection connection: Connection
+        """
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.time()))
+                return
+
+        connection.close()
+
+    @staticmethod
+    def is_healthy(connection):
+        """Check if an idle connection can be reused
+
+        An idle connection should have nothing to read, otherwise it was
+        closed by the server or is out of sync.
+
+        :param httplib.HTTPConnection connection: Connection
+        :rtype: bool
+        """
+
+        if connection.sock is None:
+            return False
+
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return not readable
+
+    def request(self, method, body=None, headers=None):
+        """Send a request using a pooled connection
+
+        Requests failing on a reused connection because the server closed it
+        in the meantime are retried once on a new connection: when sending
+        the request fails or the connection is closed or reset before any
+        response is received. Requests timing out or failing after the
+        response started are never retried, as the server may have processed
+        them.
+
+        :param str method: HTTP method
+        :param str body: Request body
+        :param dict headers: Request headers
+        :return: A tuple consisting in the response status and body
+        :rtype: tuple
+        """
+
+        while True:
+            connection, reused = self.get()
+
+            try:
+                try:
+                    connection.request(method, self.path, body, headers or {})
+
+                except (httplib.HTTPException, socket.error) as e:
+                    if reused and not isinstance(e, socket.timeout):
+                        self.logger.debug('Sending on a reused connection '
+                                          'failed, retrying on a new one.')
+                        connection.close()
+                        continue
+
+                    raise
+
+                try:
+                    response = connection.getresponse()
+
+                except (httplib.HTTPException, socket.error) as e:
+                    if reused and self.is_stale(e):
+                        self.logger.debug('Reused connection closed by the '
+                                          'server, retrying on a new one.')
+                        connection.close()
+                        continue
+
+                    raise
+
+                data = response.read()
+
+            except:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.put(connection)
+
+            return response.status, data
+
+    @staticmethod
+    def is_stale(error):
+        """Check if a response error means the connection was stale
+
+        :param Exception error: Error raised waiting for the response
+        :return: True if the connection was closed or reset by the server
+         before sending any response
+        :rtype: bool
+        """
+
+        if isinstance(error, socket.timeout):
+            return False
+
+        # The status line is empty when the server closed the connection
+        if isinstance(error, httplib.BadStatusLine):
+            return error.line in ('', "''") or \
+                error.line.startswith('No status line received')
+
+        return isinstance(error, socket.error) and \
+            error.errno == errno.ECONNRESET
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def connection_pool(url, **kwargs):
+    """Get the shared connection pool for an URL
+
+    :param str url: Request URL
+    :param kwargs: Pool options used when creating a new pool
+    :return: The connection pool
+    :rtype: HTTPConnectionPool
+    """
+
+    with _connection_pools_lock:
+        pool = _connection_pools.get(url)
+
+        if pool is None:
+            pool = _connection_pools[url] = HTTPConnectionPool(url, **kwargs)
+
+        return pool
+
+
+def close_connection_pools():
+    """Close the idle connections of all shared connection pools"""
+
+    with _connection_pools_lock:
+        pools = _connection_pools.values()
+
+    for pool in pools:
+        pool.close()
+
+
 class SOAPClient(object):
     """SOAP client
 
+    Requests are sent over persistent connections from a connection pool
+    shared by all the clients for the same URL.
+
     :param str url: Request URL
     :param str namespace: Target namespace
+    :param int pool_size: Maximum number of idle connections kept open
+    :param float idle_timeout: Seconds an idle connection is kept open
+    :param float timeout: Socket timeout in seconds
     """
     __url__ = ''
     __namespace__ = ''
+    __pool__ = None
 
-    def __init__(self, url, namespace=None):
+    def __init__(self, url, namespace=None, pool_size=4, idle_timeout=60,
+                 timeout=30):
         self.logger = logging.getLogger(
             '.'.join([__name__, self.__class__.__name__]))
 
         self.__url__ = url
+        self.__pool__ = connection_pool(url, size=pool_size,
+                                        idle_timeout=idle_timeout,
+                                        timeout=timeout)
 
         if namespace is not None:
             self.__namespace__ = namespace
@@ -271,20 +732,14 @@ class SOAPClient(object):
 
             self.logger.debug('Sending SOAP request:\n{0}'.format(request))
 
-            try:
-                request = urllib2.urlopen(urllib2.Request(
-                    self.__url__, request, headers={
-                        'Content-Type': 'text/xml; charset=utf-8',
-                        'Soapaction': 'urn:{0}'.format(method),
-                    }),
-                )
-
-                response = request.read()
-
-            except urllib2.HTTPError as e:
-                response = e.read()
+            status, response = self.__pool__.request(
+                'POST', request, headers={
+                    'Content-Type': 'text/xml; charset=utf-8',
+                    'Soapaction': 'urn:{0}'.format(method),
+                })
 
-            self.logger.debug('Received response:\n{0}'.format(response))
+            self.logger.debug('Received response:\n({0})\n{1}'
+                              .format(status, response))
 
             # Deserialize the response
             soap_response = ElementBase.from_string(response)
@@ -0,0 +1,128 @@
+"""
+bdosoa - SPG messages helpers
+"""
+
+import libspg
+
+from libspg.bdo import QueryBdoSVsReply
+from lxml import etree
+
+
+def subscription_version_data(sv):
+    """Build the SPG subscription version data for a subscription version
+
+    :param sv: SubscriptionVersion instance or row
+    :return: The subscription version data
+    :rtype: libspg.SubscriptionVersionData
+    """
+
+    return libspg.SubscriptionVersionData(
+        libspg.TNVersionId(
+            tn=sv.subscription_version_tn,
+            version_id=sv.subscription_version_id,
+        ),
+        libspg.SubscriptionData(
+            subscription_recipient_sp=sv.subscription_recipient_sp,
+            subscription_recipient_eot=sv.subscription_recipient_eot,
+            subscription_activation_timestamp=sv.subscription_activation_timestamp,
+            broadcast_window_start_timestamp=sv.subscription_broadcast_timestamp,
+            subscription_rn1=sv.subscription_rn1,
+            subscription_new_cnl=sv.subscription_new_cnl,
+            subscription_lnp_type=sv.subscription_lnp_type,
+            subscription_download_reason=sv.subscription_download_reason,
+            subscription_line_type=sv.subscription_line_type,
+            subscription_optional_data=sv.subscription_optional_data,
+        )
+    )
+
+
+class QueryBdoSVsStreamReply(QueryBdoSVsReply):
+    """QueryBdoSVs reply serialized incrementally from database rows
+
+    The reply envelope is rendered (and validated) without subscription
+    versions, then each row is serialized on its own as it is fetched, so
+    no document tree or object list for the whole result is kept in memory.
+    The serialized reply is kept, as it is used more than once.
+
+    The serialized subscription versions (``content``) do not depend on the
+    message header, so they may be cached and given instead of the rows.
+
+    The whole reply is still built in memory before it is sent, so memory
+    use is not bounded by the settings: it grows with the query result, up
+    to about three times the reply size while rendering. Only the cached
+    results are limited, by ``soap_query_result_max_rows`` and
+    ``soap_query_result_cache_bytes``.
+
+    :param libspg.MessageHeader message_header: Reply message header
+    :param rows: Subscription version rows result
+    :param str content: Serialized subscription versions
+    :param int count: Number of serialized subscription versions
+    :param int chunk_size: Number of rows fetched at a time
+    """
+
+    # Namespace declarations repeated on each serialized row
+    __declarations__ = etree.tostring(libspg.E('_'))[2:-2]
+
+    def __init__(self, message_header, rows=None, content=None, count=None,
+                 chunk_size=1000):
+        super(QueryBdoSVsStreamReply, self).__init__(message_header, [])
+
+        self.tag = QueryBdoSVsReply.__name__
+
+        self.rows = rows
+        self.content = content
+        self.count = count
+        self.chunk_size = chunk_size
+        self.serialized = None
+
+    def __str__(self):
+        if self.serialized is None:
+            self.serialized = self.render()
+
+        return self.serialized
+
+    def render(self):
+        """Serialize the reply
+
+        :return: The serialized reply
+        :rtype: str
+        """
+
+        if self.content is None:
+            self.content = self.render_content()
+
+        # The message content is rendered inside the reply command element,
+        # empty on the envelope
+        prefix, suffix = super(QueryBdoSVsStreamReply, self).__str__().split(
+            '<{0}/>'.format(self.tag))
+
+        return ''.join([prefix, '<{0}>'.format(self.tag), self.content,
+                        '</{0}>'.format(self.tag), suffix])
+
+    def render_content(self):
+        """Serialize the subscription versions from the rows
+
+        :return: The serialized subscription versions
+        :rtype: str
+        """
+
+        parts = []
+        self.count = 0
+
+        while True:
+            rows = self.rows.fetchmany(self.chunk_size)
+
+            if not rows:
+                break
+
+            for row in rows:
+                parts.append(etree.tostring(
+                    libspg.E(self.__class__.message_content.inner_tag,
+                             *subscription_version_data(row)),
+                    encoding='utf-8',
+                    pretty_print=True,
+                ).replace(self.__declarations__, '', 1))
+
+            self.count += len(rows)
+
+        return ''.join(parts)
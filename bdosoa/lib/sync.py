@@ -0,0 +1,221 @@
+"""
+bdosoa - sync storage modes
+"""
+
+from sqlalchemy import and_, func, literal, select
+
+from bdosoa.model import (ServiceProviderGateway, SubscriptionVersion,
+                          SVChange, SyncClient, SyncTask)
+
+
+class TaskStorage(object):
+    """Sync tasks stored as one row per sync client and subscription version
+
+    Each task is deleted on its own once acknowledged by the client.
+    """
+
+    table = SyncTask.__table__
+
+    def create(self, db, spg_id, sv_id):
+        """Record a subscription version change for the gateway sync clients
+
+        Pending tasks of the subscription version are coalesced: they are
+        replaced by a single new task, with a new ID, for every enabled sync
+        client of the gateway, so the clients fetch only the latest state.
+
+        :param db: Database session
+        :param int spg_id: Service Provider Gateway ID
+        :param int sv_id: Subscription version primary key
+        :return: Number of tasks created
+        :rtype: int
+        """
+
+        clients = select([SyncClient.id]).where(and_(
+            SyncClient.service_provider_gateway_id == spg_id,
+            SyncClient.enabled,
+        ))
+
+        db.execute(self.table.delete().where(and_(
+            self.table.c.subscription_version_id == sv_id,
+            self.table.c.sync_client_id.in_(clients),
+        )))
+
+        return db.execute(self.table.insert().from_select(
+            ['sync_client_id', 'subscription_version_id'],
+            clients.column(literal(sv_id)))).rowcount
+
+    def criterion(self, sync_client):
+        """Get the criterion of the pending tasks of a sync client
+
+        :param sync_client: Sync client snapshot
+        """
+
+        return self.table.c.sync_client_id == sync_client.id
+
+    def pending(self, sync_client, after=0, upto=None):
+        """Build the query of the pending task IDs of a sync client
+
+        :param sync_client: Sync client snapshot
+        :param int after: List the tasks after this ID
+        :param int upto: List the tasks up to this ID
+        :return: The select statement, ordered by task ID
+        """
+
+        criteria = [self.criterion(sync_client), self.table.c.id > after]
+
+        if upto is not None:
+            criteria.append(self.table.c.id <= upto)
+
+        return select([self.table.c.id]).where(and_(*criteria)) \
+            .order_by(self.table.c.id)
+
+    def position(self, sync_client):
+        """Build the query of the last pending task ID of a sync client
+
+        :param sync_client: Sync client snapshot
+        :return: The select statement
+        """
+
+        return select([func.max(self.table.c.id)]).where(
+            self.criterion(sync_client))
+
+    def details(self, sync_client, tasks):
+        """Build the query of the subscription versions of pending tasks
+
+        :param sync_client: Sync client snapshot
+        :param list tasks: Task IDs
+        :return: The select statement, with the task ID as ``sync_task_id``
+         and the subscription version columns
+        """
+
+        sv = SubscriptionVersion.__table__
+
+        return select([self.table.c.id.label('sync_task_id'), sv]).select_from(
+            self.table.join(
+                sv, sv.c.id == self.table.c.subscription_version_id)
+        ).where(and_(
+            self.criterion(sync_client),
+            self.table.c.id.in_(tasks),
+        ))
+
+    def delete(self, db, sync_client, tasks, upto=None, chunk_size=1000):
+        """Acknowledge tasks of a sync client
+
+        :param db: Database session
+        :param sync_client: Sync client snapshot
+        :param list tasks: IDs of the tasks to delete, missing tasks are
+         ignored
+        :param int upto: Delete all the tasks up to this ID
+        :param int chunk_size: Maximum number of IDs on each statement
+        """
+
+        if upto is not None:
+            db.execute(self.table.delete().where(and_(
+                self.criterion(sync_client),
+                self.table.c.id <= upto,
+            )))
+
+            tasks = [t for t in tasks if t > upto]
+
+        for i in range(0, len(tasks), chunk_size):
+            db.execute(self.table.delete().where(and_(
+                self.criterion(sync_client),
+                self.table.c.id.in_(tasks[i:i + chunk_size]),
+            )))
+
+
+class ChangeLogStorage(TaskStorage):
+    """Sync tasks stored as a single change log for each gateway
+
+    Each change is a task of every sync client of the gateway, so the write
+    load does not grow with the number of clients. The clients keep the ID
+    of the last acknowledged change (``change_cursor``), which acknowledges
+    all the previous changes too, and the changes already acknowledged by
+    all the enabled clients are removed by :meth:`truncate`.
+    """
+
+    table = SVChange.__table__
+
+    def create(self, db, spg_id, sv_id):
+        # Earlier changes of the subscription version are superseded
+        db.execute(self.table.delete().where(
+            self.table.c.subscription_version_id == sv_id))
+
+        db.execute(self.table.insert().values(
+            service_provider_gateway_id=spg_id,
+            subscription_version_id=sv_id,
+        ))
+
+        return 1
+
+    def criterion(self, sync_client):
+        # The cursor on the client snapshot may be outdated
+        cursor = select([SyncClient.change_cursor]).where(
+            SyncClient.id == sync_client.id).as_scalar()
+
+        return and_(
+            self.table.c.service_provider_gateway_id ==
+            sync_client.service_provider_gateway_id,
+            self.table.c.id > cursor,
+        )
+
+    def delete(self, db, sync_client, tasks, upto=None, chunk_size=1000):
+        cursor = 0
+
+        # Changes not created yet are not acknowledged
+        if upto is not None:
+            cursor = min(upto, db.execute(
+                select([func.max(self.table.c.id)]).where(
+                    self.table.c.service_provider_gateway_id ==
+                    sync_client.service_provider_gateway_id)
+            ).scalar() or 0)
+
+        # Only the pending listed changes move the cursor
+        for i in range(0, len(tasks), chunk_size):
+            cursor = max(cursor, db.execute(
+                select([func.max(self.table.c.id)]).where(and_(
+                    self.criterion(sync_client),
+                    self.table.c.id.in_(tasks[i:i + chunk_size]),
+                ))).scalar() or 0)
+
+        db.execute(SyncClient.__table__.update().where(and_(
+            SyncClient.id == sync_client.id,
+            SyncClient.change_cursor < cursor,
+        )).values(change_cursor=cursor))
+
+    def truncate(self, db):
+        """Remove the changes acknowledged by all the enabled sync clients
+
+        :param db: Database session
+        :return: Number of changes removed
+        :rtype: int
+        """
+
+        cursors = dict(db.execute(
+            select([SyncClient.service_provider_gateway_id,
+                    func.min(SyncClient.change_cursor)])
+            .where(SyncClient.enabled)
+            .group_by(SyncClient.service_provider_gateway_id)
+        ).fetchall())
+
+        count = 0
+
+        for (spg_id,) in db.execute(
+                select([ServiceProviderGateway.id])).fetchall():
+            criteria = [self.table.c.service_provider_gateway_id == spg_id]
+
+            # Gateways without enabled clients keep no changes
+            if spg_id in cursors:
+                criteria.append(self.table.c.id <= cursors[spg_id])
+
+            count += db.execute(
+                self.table.delete().where(and_(*criteria))).rowcount
+
+        return count
+
+
+#: Sync storages by sync mode name
+STORAGES = {
+    'tasks': TaskStorage(),
+    'changelog': ChangeLogStorage(),
+}
@@ -2,12 +2,29 @@
 bdosoa - database ORM models
 """
 
-from sqlalchemy import (Column, Index, ForeignKey, Boolean, DateTime, Enum,
-                        Integer, String, Text, UniqueConstraint)
+from datetime import datetime
+from sqlalchemy import (Column, Index, ForeignKey, BigInteger, Boolean,
+                        DateTime, Enum, Integer, String, Text,
+                        UniqueConstraint, and_, case, select)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
 
 from bdosoa.lib.util import gen_token
-from bdosoa.model.meta import Base
+from bdosoa.model.meta import Base, NoResultFound
+
+try:
+    from sqlalchemy.dialects import sqlite
+    sqlite.insert
+
+# SQLAlchemy < 1.4
+except AttributeError:
+    sqlite = None
+
+#: Insert constructs supporting ON CONFLICT DO UPDATE by dialect name
+UPSERT_DIALECTS = dict(
+    (name, dialect.insert) for name, dialect in
+    (('postgresql', postgresql), ('sqlite', sqlite)) if dialect is not None
+)
 
 
 class ServiceProviderGateway(Base):
@@ -22,6 +39,8 @@ class ServiceProviderGateway(Base):
     soap_url = Column(String, nullable=False)
     description = Column(String)
     enabled = Column(Boolean, nullable=False, default=True)
+    data_version = Column(Integer, nullable=False, default=0,
+                          server_default='0')
 
     subscription_versions = relationship('SubscriptionVersion',
                                          backref='service_provider_gateway',
@@ -33,6 +52,26 @@ class ServiceProviderGateway(Base):
                                 lazy='dynamic',
                                 cascade='all, delete, delete-orphan')
 
+    inbound_messages = relationship('InboundMessage',
+                                    backref='service_provider_gateway',
+                                    lazy='dynamic',
+                                    cascade='all, delete, delete-orphan')
+
+    outbound_messages = relationship('OutboundMessage',
+                                     backref='service_provider_gateway',
+                                     lazy='dynamic',
+                                     cascade='all, delete, delete-orphan')
+
+    processed_messages = relationship('ProcessedMessage',
+                                      backref='service_provider_gateway',
+                                      lazy='dynamic',
+                                      cascade='all, delete, delete-orphan')
+
+    sv_changes = relationship('SVChange',
+                              backref='service_provider_gateway',
+                              lazy='dynamic',
+                              cascade='all, delete, delete-orphan')
+
 
 class SubscriptionVersion(Base):
     """Versao de Subscricao (Bilhete de portabilidade)"""
@@ -41,6 +80,8 @@ class SubscriptionVersion(Base):
     __table_args__ = (
         UniqueConstraint('service_provider_gateway_id',
                          'subscription_version_id'),
+        Index('ix_subscription_version_service_provider_gateway_id_tn',
+              'service_provider_gateway_id', 'subscription_version_tn'),
     )
 
     subscription_version_id = Column(Integer, nullable=False)
@@ -63,6 +104,103 @@ class SubscriptionVersion(Base):
                                          ForeignKey(ServiceProviderGateway.id),
                                          nullable=False)
 
+    @classmethod
+    def upsert(cls, session, spg_id, version_id, values, keep_on_deleted=(),
+               orm=False):
+        """Create or update a subscription version
+
+        On PostgreSQL and SQLite a single INSERT ... ON CONFLICT DO UPDATE
+        statement is used, on other databases (or if ``orm`` is set) the
+        subscription version is loaded and updated through the ORM.
+
+        :param sqlalchemy.orm.Session session: Database session
+        :param int spg_id: Service Provider Gateway ID
+        :param int version_id: Subscription version ID
+        :param dict values: Column values
+        :param list keep_on_deleted: Columns not changed on deleted
+         subscription versions
+        :param bool orm: Always use the ORM
+        :return: The subscription version ID, TN and deletion timestamp
+        """
+
+        table = cls.__table__
+        insert = UPSERT_DIALECTS.get(session.get_bind().dialect.name)
+
+        if orm or insert is None:
+            return cls.orm_upsert(session, spg_id, version_id, values,
+                                  keep_on_deleted)
+
+        statement = insert(table).values(
+            service_provider_gateway_id=spg_id,
+            subscription_version_id=version_id,
+            **values)
+
+        updates = dict((key, getattr(statement.excluded, key))
+                       for key in values)
+
+        for key in keep_on_deleted:
+            updates[key] = case(
+                [(table.c.subscription_deletion_timestamp.is_(None),
+                  getattr(statement.excluded, key))],
+                else_=table.c[key])
+
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.service_provider_gateway_id,
+                            table.c.subscription_version_id],
+            set_=updates)
+
+        columns = [table.c.id, table.c.subscription_version_tn,
+                   table.c.subscription_deletion_timestamp]
+
+        if session.get_bind().dialect.implicit_returning:
+            return session.execute(statement.returning(*columns)).first()
+
+        session.execute(statement)
+
+        return session.execute(select(columns).where(and_(
+            table.c.service_provider_gateway_id == spg_id,
+            table.c.subscription_version_id == version_id,
+        ))).first()
+
+    @classmethod
+    def orm_upsert(cls, session, spg_id, version_id, values,
+                   keep_on_deleted=()):
+        """Create or update a subscription version through the ORM
+
+        :param sqlalchemy.orm.Session session: Database session
+        :param int spg_id: Service Provider Gateway ID
+        :param int version_id: Subscription version ID
+        :param dict values: Column values
+        :param list keep_on_deleted: Columns not changed on deleted
+         subscription versions
+        :return: The subscription version
+        :rtype: SubscriptionVersion
+        """
+
+        try:
+            sv = session.query(cls).filter_by(
+                service_provider_gateway_id=spg_id,
+                subscription_version_id=version_id,
+            ).one()
+
+        except NoResultFound:
+            sv = cls(
+                service_provider_gateway_id=spg_id,
+                subscription_version_id=version_id,
+            )
+            session.add(sv)
+            session.flush()
+
+        for key, value in values.items():
+            if key in keep_on_deleted and \
+                    sv.subscription_deletion_timestamp is not None:
+                continue
+
+            setattr(sv, key, value)
+
+        return sv
+
+
 class SyncClient(Base):
     """Cliente de Sincronismo"""
 
@@ -74,6 +212,8 @@ class SyncClient(Base):
     token = Column(String, nullable=False, default=gen_token)
     description = Column(String)
     enabled = Column(Boolean, nullable=False, default=True)
+    change_cursor = Column(BigInteger, nullable=False, default=0,
+                           server_default='0')
 
     service_provider_gateway_id = Column(Integer,
                                          ForeignKey(ServiceProviderGateway.id),
@@ -89,6 +229,7 @@ class SyncTask(Base):
     __tablename__ = 'sync_task'
     __table_args__ = (
         UniqueConstraint('sync_client_id', 'subscription_version_id'),
+        Index('ix_sync_task_sync_client_id_id', 'sync_client_id', 'id'),
     )
 
     sync_client_id = Column(Integer, ForeignKey(SyncClient.id), nullable=False)
@@ -96,3 +237,89 @@ class SyncTask(Base):
     subscription_version_id = Column(Integer,
                                      ForeignKey(SubscriptionVersion.id),
                                      nullable=False)
+
+
+class SVChange(Base):
+    """Alteracao de Versao de Subscricao (log de sincronismo)"""
+
+    __tablename__ = 'sv_change'
+    __table_args__ = (
+        Index('ix_sv_change_service_provider_gateway_id_id',
+              'service_provider_gateway_id', 'id'),
+    )
+
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    subscription_version_id = Column(Integer,
+                                     ForeignKey(SubscriptionVersion.id),
+                                     nullable=False, index=True)
+
+    service_provider_gateway_id = Column(Integer,
+                                         ForeignKey(ServiceProviderGateway.id),
+                                         nullable=False)
+
+
+class InboundMessage(Base):
+    """Mensagem de entrada (fila de processamento)"""
+
+    __tablename__ = 'inbound_message'
+    __table_args__ = (
+        Index('ix_inbound_message_service_provider_gateway_id_status',
+              'service_provider_gateway_id', 'status', 'id'),
+    )
+
+    header = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    status = Column(Enum('pending', 'failed', name='inbound_status'),
+                    nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime)
+    last_error = Column(Text)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    service_provider_gateway_id = Column(Integer,
+                                         ForeignKey(ServiceProviderGateway.id),
+                                         nullable=False)
+
+
+class OutboundMessage(Base):
+    """Mensagem de saida (fila de envio)"""
+
+    __tablename__ = 'outbound_message'
+    __table_args__ = (
+        Index('ix_outbound_message_service_provider_gateway_id_status',
+              'service_provider_gateway_id', 'status', 'id'),
+    )
+
+    header = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    status = Column(Enum('pending', 'failed', name='outbound_status'),
+                    nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime)
+    last_error = Column(Text)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    service_provider_gateway_id = Column(Integer,
+                                         ForeignKey(ServiceProviderGateway.id),
+                                         nullable=False)
+
+
+class ProcessedMessage(Base):
+    """Mensagem processada (deteccao de retransmissoes)"""
+
+    __tablename__ = 'processed_message'
+    __table_args__ = (
+        UniqueConstraint('service_provider_gateway_id', 'invoke_id',
+                         'message_type'),
+    )
+
+    invoke_id = Column(Integer, nullable=False)
+    message_type = Column(String, nullable=False)
+    reply = Column(Text)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow,
+                     index=True)
+
+    service_provider_gateway_id = Column(Integer,
+                                         ForeignKey(ServiceProviderGateway.id),
+                                         nullable=False)
@@ -3,9 +3,12 @@ bdosoa - SQLAlchemy helper code
 """
 
 import cherrypy
+import sqlalchemy.event
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 
+from collections import namedtuple
+
 
 # noinspection PyUnresolvedReferences
 class Base(object):
@@ -14,6 +17,26 @@ class Base(object):
     id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True,
                            nullable=False, autoincrement=True)
 
+    def snapshot(self):
+        """Return a detached, read-only copy of the column attributes
+
+        :return: A named tuple with the column attribute values
+        :rtype: tuple
+        """
+
+        cls = self.__class__
+        snapshot_class = cls.__dict__.get('__snapshot_class__')
+
+        if snapshot_class is None:
+            snapshot_class = namedtuple(
+                cls.__name__ + 'Snapshot',
+                [attr.key for attr in sqlalchemy.inspect(cls).column_attrs])
+
+            cls.__snapshot_class__ = snapshot_class
+
+        return snapshot_class(
+            *[getattr(self, key) for key in snapshot_class._fields])
+
 Base = sqlalchemy.ext.declarative.declarative_base(cls=Base)
 Base.metadata.naming_convention = {
     'pk': 'pk_%(table_name)s',
@@ -56,3 +79,26 @@ class scoped_session(sqlalchemy.orm.scoped_session):
 sessionmaker = sqlalchemy.orm.sessionmaker
 
 NoResultFound = sqlalchemy.orm.exc.NoResultFound
+
+
+def publish_after_commit(session, channel, *args):
+    """Publish a message on the CherryPy bus once the session is committed
+
+    :param sqlalchemy.orm.Session session: Database session
+    :param str channel: Bus channel
+    :param args: Message arguments
+    """
+
+    session.info.setdefault('publish_after_commit', []).append(
+        (channel, args))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _publish_after_commit(session):
+    for channel, args in session.info.pop('publish_after_commit', []):
+        cherrypy.engine.publish(channel, *args)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('publish_after_commit', None)
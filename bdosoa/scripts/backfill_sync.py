@@ -0,0 +1,202 @@
+"""
+BDOSOA - sync tasks backfill utility
+"""
+
+import cherrypy
+import logging
+import sqlalchemy
+import sqlalchemy.orm
+import time
+
+from optparse import OptionParser
+from sqlalchemy import and_, exists, func, literal, select
+from sqlalchemy.exc import IntegrityError
+
+from bdosoa.model import (ServiceProviderGateway, SubscriptionVersion,
+                          SyncClient, SyncTask)
+from bdosoa.model.meta import NoResultFound
+
+
+def backfill_chunk(db_session, sync_client, start_id, end_id, skip_deleted):
+    """Create the missing sync tasks of a subscription versions ID range
+
+    :param db_session: Database session
+    :param SyncClient sync_client: Sync client
+    :param int start_id: First subscription version ID
+    :param int end_id: Subscription version ID after the range
+    :param bool skip_deleted: Skip the deleted subscription versions
+    :return: Number of tasks created
+    :rtype: int
+    """
+
+    sv = SubscriptionVersion.__table__
+    task = SyncTask.__table__
+
+    # Lock the gateway row with the update used by the SOAP processing, so
+    # the tasks are committed in the order of their IDs and the SOAP
+    # processing does not insert tasks of the range meanwhile
+    db_session.execute(ServiceProviderGateway.__table__.update().where(
+        ServiceProviderGateway.id == sync_client.service_provider_gateway_id
+    ).values(data_version=ServiceProviderGateway.data_version + 1))
+
+    criteria = [
+        sv.c.service_provider_gateway_id ==
+        sync_client.service_provider_gateway_id,
+        sv.c.id >= start_id,
+        sv.c.id < end_id,
+        ~exists().where(and_(
+            task.c.sync_client_id == sync_client.id,
+            task.c.subscription_version_id == sv.c.id,
+        )),
+    ]
+
+    if skip_deleted:
+        criteria.append(sv.c.subscription_deletion_timestamp.is_(None))
+
+    return db_session.execute(task.insert().from_select(
+        ['sync_client_id', 'subscription_version_id'],
+        select([literal(sync_client.id), sv.c.id]).where(and_(*criteria))
+    )).rowcount
+
+
+def main(args=None):
+    opts = OptionParser(usage='usage: %prog [options]')
+    opts.add_option('-c', '--config', action='append',
+                    help='specify config file', default=[])
+    opts.add_option('-d', '--debug', action='store_true', default=False,
+                    help='enable debug messages')
+    opts.add_option('-q', '--quiet', action='store_true', default=False,
+                    help='only log warnings and errors')
+    opts.add_option('-s', '--spid', help='Service Provider ID')
+    opts.add_option('-t', '--token', help='Sync client token')
+    opts.add_option('--chunk-size', type='int', default=10000,
+                    help='subscription version IDs by transaction, the '
+                         'gateway messages wait for each transaction '
+                         '[default: %default]')
+    opts.add_option('--retries', type='int', default=3,
+                    help='attempts by chunk on conflicts [default: %default]')
+    opts.add_option('--skip-deleted', action='store_true', default=False,
+                    help='skip the deleted subscription versions')
+    opts.add_option('--sleep', type='float', default=0,
+                    help='seconds to wait between chunks [default: %default]')
+    opts.add_option('--start-id', type='int', default=0,
+                    help='first subscription version ID, to resume an '
+                         'interrupted backfill [default: %default]')
+
+    options, args = opts.parse_args(args)
+
+    if not (options.spid and options.token):
+        opts.error('You must specify the Service Provider ID and '
+                   'Sync client token')
+
+    if options.chunk_size < 1:
+        opts.error('The chunk size must be positive')
+
+    if options.retries < 1:
+        opts.error('The chunk must be attempted at least once')
+
+    # Set logging level
+    if options.debug and options.quiet:
+        opts.error('You may only specify one of the debug, quiet options')
+
+    log_format = '%(asctime)s <%(name)s:%(levelname)s> %(message)s'
+    if options.debug:
+        logging.basicConfig(level=logging.DEBUG, format=log_format)
+    elif options.quiet:
+        logging.basicConfig(level=logging.ERROR, format=log_format)
+    else:
+        logging.basicConfig(level=logging.INFO, format=log_format)
+
+    logger = logging.getLogger(__package__)
+    logger.debug('Debugging enabled.')
+
+    logger.debug('Reading configuration files: {0}'
+                 .format(', '.join(options.config)))
+
+    # Merge configuration files
+    for c in options.config:
+        cherrypy.config.update(c)
+
+    if cherrypy.config.get('sync_mode', 'tasks') != 'tasks':
+        opts.error('Sync tasks are only stored on the tasks sync mode, use '
+                   'the sync snapshot to bootstrap the client')
+
+    logger.debug('Creating SQLAlchemy engine.')
+    db_engine = sqlalchemy.engine_from_config(cherrypy.config)
+
+    db_session = sqlalchemy.orm.sessionmaker(bind=db_engine)()
+
+    try:
+        try:
+            sync_client = db_session.query(SyncClient) \
+                .join(ServiceProviderGateway) \
+                .filter(
+                    ServiceProviderGateway.service_provider_id ==
+                    options.spid,
+                    SyncClient.token == options.token,
+                ).one().snapshot()
+
+        except NoResultFound:
+            raise RuntimeError('Sync client not found')
+
+        # Tasks for the changes saved during the backfill are created by the
+        # SOAP processing only for enabled clients
+        if not sync_client.enabled:
+            raise RuntimeError('The sync client must be enabled before the '
+                               'backfill')
+
+        # Subscription versions created later have their tasks created by
+        # the SOAP processing
+        max_id = db_session.execute(
+            select([func.max(SubscriptionVersion.id)]).where(
+                SubscriptionVersion.service_provider_gateway_id ==
+                sync_client.service_provider_gateway_id)
+        ).scalar()
+        db_session.commit()
+
+        start_id = options.start_id
+        total = 0
+
+        while max_id is not None and start_id <= max_id:
+            end_id = start_id + options.chunk_size
+
+            for attempt in range(1, options.retries + 1):
+                try:
+                    count = backfill_chunk(db_session, sync_client, start_id,
+                                           end_id, options.skip_deleted)
+                    db_session.commit()
+                    break
+
+                # Conflict with a task created by other means
+                except IntegrityError:
+                    db_session.rollback()
+
+                    if attempt == options.retries:
+                        raise
+
+                    logger.warn('Conflict on subscription versions {0} to '
+                                '{1}, retrying.'.format(start_id, end_id - 1))
+
+            total += count
+            logger.info('Created {0} sync tasks for subscription versions {1} '
+                        'to {2}, resume with --start-id {3}.'
+                        .format(count, start_id, end_id - 1, end_id))
+
+            start_id = end_id
+
+            if options.sleep and start_id <= max_id:
+                time.sleep(options.sleep)
+
+        logger.info('Done, created {0} sync tasks.'.format(total))
+
+    except:
+        logger.exception('Error creating the sync tasks.')
+        db_session.rollback()
+        raise
+
+    finally:
+        db_session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+BDOSOA - subscription version write path micro-benchmark
+"""
+
+import logging
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import time
+
+from datetime import datetime
+from optparse import OptionParser
+from sqlalchemy import BigInteger
+from sqlalchemy.ext.compiler import compiles
+
+from bdosoa.model import Base, ServiceProviderGateway, SubscriptionVersion
+
+
+# SQLite only generates primary keys for INTEGER PRIMARY KEY columns
+# noinspection PyUnusedLocal
+@compiles(BigInteger, 'sqlite')
+def compile_big_integer(type_, compiler, **kwargs):
+    return 'INTEGER'
+
+
+def create_values(version_id, rn1='55123'):
+    return {
+        'subscription_version_tn': str(11900000000 + version_id),
+        'subscription_recipient_sp': '0123',
+        'subscription_recipient_eot': '0123',
+        'subscription_activation_timestamp': datetime(2015, 1, 1),
+        'subscription_broadcast_timestamp': None,
+        'subscription_rn1': rn1,
+        'subscription_new_cnl': '11000',
+        'subscription_lnp_type': 'lspp',
+        'subscription_download_reason': 'new',
+        'subscription_line_type': 'Basic',
+        'subscription_optional_data': None,
+    }
+
+
+def modify_values(version_id):
+    return dict(create_values(version_id, rn1='55321'),
+                subscription_download_reason='modified')
+
+
+def delete_values(version_id):
+    return {
+        'subscription_download_reason': 'delete',
+        'subscription_deletion_timestamp': datetime(2015, 1, 2),
+    }
+
+
+def run(db_session, spg_id, count, orm):
+    """Save ``count`` new subscription versions, update and delete them,
+    committing after each message like the SOAP handlers
+
+    :return: Statements executed and elapsed seconds by step
+    :rtype: list
+    """
+
+    statements = [0]
+
+    # noinspection PyUnusedLocal
+    def count_statement(*args):
+        statements[0] += 1
+
+    engine = db_session.get_bind()
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+
+    results = []
+
+    try:
+        for step, values, keep in (
+                ('create', create_values, ['subscription_download_reason']),
+                ('modify', modify_values, ['subscription_download_reason']),
+                ('delete', delete_values, ())):
+            statements[0] = 0
+            start = time.time()
+
+            for version_id in range(count):
+                SubscriptionVersion.upsert(
+                    db_session, spg_id, version_id, values(version_id),
+                    keep_on_deleted=keep, orm=orm)
+                db_session.commit()
+
+            results.append((step, statements[0], time.time() - start))
+
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                count_statement)
+
+    return results
+
+
+def main(args=None):
+    opts = OptionParser(usage='usage: %prog [options]')
+    opts.add_option('-n', '--count', type='int', default=1000,
+                    help='number of subscription versions [default: %default]')
+    opts.add_option('-u', '--url', default='sqlite://',
+                    help='database URL, the schema is created if missing '
+                         '[default: %default]')
+
+    options, args = opts.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger(__package__)
+
+    db_engine = sqlalchemy.create_engine(options.url)
+    Base.metadata.create_all(db_engine)
+
+    db_session = sqlalchemy.orm.sessionmaker(bind=db_engine)()
+
+    logger.info('{0:8} {1:8} {2:>12} {3:>12}'.format(
+        'path', 'step', 'stmts/msg', 'ms/msg'))
+
+    for path, orm in (('orm', True), ('upsert', False)):
+        spg = ServiceProviderGateway(
+            service_provider_id='benchmark-{0}'.format(path),
+            soap_url='http://localhost/')
+        db_session.add(spg)
+        db_session.commit()
+
+        for step, statements, elapsed in run(
+                db_session, spg.id, options.count, orm):
+            logger.info('{0:8} {1:8} {2:12.2f} {3:12.3f}'.format(
+                path, step, float(statements) / options.count,
+                elapsed * 1000 / options.count))
+
+        db_session.delete(spg)
+        db_session.commit()
+
+
+if __name__ == '__main__':
+    main()
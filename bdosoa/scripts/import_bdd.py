@@ -156,6 +156,13 @@ def main(args=None):
                 else:
                     row_count += 1
 
+            # Expire the cached query results of the gateway
+            db_session.execute(
+                ServiceProviderGateway.__table__.update().where(
+                    ServiceProviderGateway.id == spg.id
+                ).values(
+                    data_version=ServiceProviderGateway.data_version + 1))
+
             # Commit database session
             try:
                 logger.debug('Committing database session.')
@@ -0,0 +1,132 @@
+"""
+BDOSOA - database schema upgrade utility
+"""
+
+import cherrypy
+import logging
+import sqlalchemy
+
+from optparse import OptionParser
+from sqlalchemy.schema import CreateColumn
+
+from bdosoa.model.meta import Base
+
+
+def upgrade(db_engine, dry_run=False):
+    """Bring an existing database up to the current schema
+
+    Missing tables are created with their indexes. Missing columns are
+    added to the existing tables, using their server default to fill the
+    existing rows, and missing indexes are created.
+
+    :param sqlalchemy.engine.Engine db_engine: Database engine
+    :param bool dry_run: Only log the changes
+    :return: Descriptions of the changes
+    :rtype: list
+    """
+
+    logger = logging.getLogger(__name__)
+    inspector = sqlalchemy.inspect(db_engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+
+    with db_engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                changes.append('Create table {0}'.format(table.name))
+                logger.info(changes[-1])
+
+                if not dry_run:
+                    table.create(connection)
+
+                continue
+
+            columns = set(column['name']
+                          for column in inspector.get_columns(table.name))
+
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(
+                        'Column {0}.{1} can not be added without a server '
+                        'default'.format(table.name, column.name))
+
+                changes.append('Add column {0}.{1}'.format(table.name,
+                                                           column.name))
+                logger.info(changes[-1])
+
+                if not dry_run:
+                    connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                        table.name,
+                        CreateColumn(column).compile(dialect=db_engine.dialect)
+                    ))
+
+            indexes = set(index['name']
+                          for index in inspector.get_indexes(table.name))
+
+            for index in table.indexes:
+                if index.name in indexes:
+                    continue
+
+                changes.append('Create index {0}'.format(index.name))
+                logger.info(changes[-1])
+
+                if not dry_run:
+                    index.create(connection)
+
+    return changes
+
+
+def main(args=None):
+    opts = OptionParser(usage='usage: %prog [options]')
+    opts.add_option('-c', '--config', action='append',
+                    help='specify config file', default=[])
+    opts.add_option('-d', '--debug', action='store_true', default=False,
+                    help='enable debug messages')
+    opts.add_option('-n', '--dry-run', action='store_true', default=False,
+                    help='only list the changes')
+    opts.add_option('-q', '--quiet', action='store_true', default=False,
+                    help='only log warnings and errors')
+
+    options, args = opts.parse_args(args)
+
+    # Set logging level
+    if options.debug and options.quiet:
+        opts.error('You may only specify one of the debug, quiet options')
+
+    log_format = '%(asctime)s <%(name)s:%(levelname)s> %(message)s'
+    if options.debug:
+        logging.basicConfig(level=logging.DEBUG, format=log_format)
+    elif options.quiet:
+        logging.basicConfig(level=logging.ERROR, format=log_format)
+    else:
+        logging.basicConfig(level=logging.INFO, format=log_format)
+
+    logger = logging.getLogger(__package__)
+    logger.debug('Debugging enabled.')
+
+    logger.debug('Reading configuration files: {0}'
+                 .format(', '.join(options.config)))
+
+    # Merge configuration files
+    for c in options.config:
+        cherrypy.config.update(c)
+
+    logger.debug('Creating SQLAlchemy engine.')
+    db_engine = sqlalchemy.engine_from_config(cherrypy.config)
+
+    try:
+        changes = upgrade(db_engine, options.dry_run)
+
+    except:
+        logger.exception('Error upgrading the database.')
+        raise
+
+    logger.info('Done, {0} changes{1}.'.format(
+        len(changes), ' to apply' if options.dry_run else ' applied'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+bdosoa - unit tests
+
+Run with ``python -m unittest discover -s bdosoa/tests -t .``.
+"""
+
+import atexit
+import cherrypy
+import httplib
+import os
+import socket
+import sqlalchemy
+import sqlalchemy.orm
+import tempfile
+import unittest
+
+from datetime import datetime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import StaticPool
+
+from bdosoa.model import (ServiceProviderGateway, SubscriptionVersion,
+                          SyncClient)
+from bdosoa.model.meta import Base
+
+
+# noinspection PyUnusedLocal
+@compiles(sqlalchemy.BigInteger, 'sqlite')
+def compile_big_integer(type_, compiler, **kwargs):
+    """SQLite only generates the IDs of INTEGER PRIMARY KEY columns"""
+
+    return 'INTEGER'
+
+
+def create_engine():
+    """Create an in-memory SQLite engine with the schema
+
+    The single connection is shared by all the threads.
+
+    :return: The engine
+    """
+
+    engine = sqlalchemy.create_engine(
+        'sqlite://', poolclass=StaticPool,
+        connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+
+    return engine
+
+
+def free_port():
+    """Get a free local TCP port
+
+    :rtype: int
+    """
+
+    sock = socket.socket()
+
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+    finally:
+        sock.close()
+
+
+def start_server(**config):
+    """Serve the application on a local port
+
+    The application is mounted and the engine plugins the daemon uses are
+    subscribed once, on a temporary SQLite database removed on exit. The
+    engine must be exited before the interpreter exits, as it waits for the
+    server threads, and may be started again.
+
+    :param config: Additional settings, only applied on the first call
+    :return: The server address and the database URL
+    :rtype: tuple
+    """
+
+    if not cherrypy.tree.apps:
+        fd, path = tempfile.mkstemp(prefix='bdosoa-test-', suffix='.db')
+        os.close(fd)
+        atexit.register(os.remove, path)
+
+        cherrypy.config.update({
+            'environment': 'test_suite',
+            'log.screen': False,
+            'routing_table': False,
+            'server.socket_host': '127.0.0.1',
+            'server.socket_port': free_port(),
+            'sqlalchemy.url': 'sqlite:///{0}'.format(path),
+        })
+        cherrypy.config.update(config)
+
+        from bdosoa.cherrypy.plugin import SQLAlchemyPlugin
+        SQLAlchemyPlugin(cherrypy.engine).subscribe()
+
+        from bdosoa.cherrypy.tool import SQLAlchemyTool
+        cherrypy.tools.sqlalchemy = SQLAlchemyTool()
+
+        from bdosoa.app import App
+        cherrypy.tree.mount(App)
+
+    if cherrypy.engine.state != cherrypy.engine.states.STARTED:
+        cherrypy.engine.start()
+
+    return (cherrypy.server.socket_host, cherrypy.server.socket_port), \
+        cherrypy.config['sqlalchemy.url']
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Test case with an in-memory database and a session on ``self.db``"""
+
+    def setUp(self):
+        self.engine = create_engine()
+        self.db = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def add_gateway(self, service_provider_id='0123', **kwargs):
+        """Add a Service Provider Gateway
+
+        :param str service_provider_id: Service Provider ID
+        :return: The gateway
+        :rtype: ServiceProviderGateway
+        """
+
+        kwargs.setdefault('soap_url', 'http://spg.example.com/')
+
+        spg = ServiceProviderGateway(service_provider_id=service_provider_id,
+                                     **kwargs)
+        self.db.add(spg)
+        self.db.flush()
+
+        return spg
+
+    def add_subscription_version(self, spg, version_id, tn, **kwargs):
+        """Add a subscription version with valid SPG data
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param int version_id: Subscription version ID
+        :param str tn: Telephone number
+        :return: The subscription version
+        :rtype: SubscriptionVersion
+        """
+
+        values = dict(
+            subscription_recipient_sp='0321',
+            subscription_recipient_eot='321',
+            subscription_activation_timestamp=datetime(2015, 1, 2, 3, 4, 5),
+            subscription_rn1='55321',
+            subscription_new_cnl='11000',
+            subscription_lnp_type='lspp',
+            subscription_download_reason='new',
+            subscription_line_type='Basic',
+        )
+        values.update(kwargs)
+
+        sv = SubscriptionVersion(service_provider_gateway_id=spg.id,
+                                 subscription_version_id=version_id,
+                                 subscription_version_tn=tn, **values)
+        self.db.add(sv)
+        self.db.flush()
+
+        return sv
+
+    def add_sync_client(self, spg, token='sync-token', **kwargs):
+        """Add a sync client
+
+        :param ServiceProviderGateway spg: Service Provider Gateway
+        :param str token: Access token
+        :return: The sync client
+        :rtype: SyncClient
+        """
+
+        sync_client = SyncClient(service_provider_gateway_id=spg.id,
+                                 token=token, **kwargs)
+        self.db.add(sync_client)
+        self.db.flush()
+
+        return sync_client
+
+
+class ServerTestCase(DatabaseTestCase):
+    """Test case with the application served on a local port
+
+    ``self.db`` is a session on the server database, emptied before each
+    test along with the application caches.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.address, cls.url = start_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cherrypy.engine.exit()
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine(self.url)
+        self.db = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+
+        for table in reversed(Base.metadata.sorted_tables):
+            self.db.execute(table.delete())
+
+        self.db.commit()
+
+        from bdosoa.app import App
+        App.root.soap.gateways.clear()
+        App.root.soap.processed_messages.clear()
+        App.root.soap.sv_query_results.clear()
+        App.root.sync.clients.clear()
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request to the application
+
+        :param str method: Request method
+        :param str path: Request path, with the query string
+        :param str body: Request body
+        :param dict headers: Request headers
+        :return: The response status, headers and body
+        :rtype: tuple
+        """
+
+        connection = httplib.HTTPConnection(*self.address, timeout=30)
+
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+
+            return response.status, dict(response.getheaders()), \
+                response.read()
+
+        finally:
+            connection.close()
@@ -0,0 +1,254 @@
+"""
+bdosoa - SOAP messages processing tests
+"""
+
+import BaseHTTPServer
+import libspg
+import threading
+
+from datetime import datetime
+from libspg.bdo import (DownloadReply, QueryBdoSVs, QueryBdoSVsReply,
+                        SVCreateDownload, SVDeleteDownload)
+
+from bdosoa.lib.soap import SOAPApplication, SOAPClient
+from bdosoa.model import ServiceProviderGateway, SubscriptionVersion, SyncTask
+from bdosoa.tests import ServerTestCase, free_port
+
+
+class FakeSPG(BaseHTTPServer.HTTPServer):
+    """Service Provider Gateway SOAP server recording the received messages
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', free_port()), FakeSPGHandler)
+
+        self.messages = []
+        self.soap_app = SOAPApplication(namespace='SPG/SoapServer')
+        self.soap_app.register_method('processRequest', self.receive)
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/'.format(*self.server_address)
+
+    def receive(self, header, message):
+        self.messages.append(libspg.Message.from_string(message))
+
+        return '0'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSPGHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        status, response = self.server.soap_app.process_request(
+            self.rfile.read(int(self.headers['Content-Length'])))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class SOAPTest(ServerTestCase):
+
+    def setUp(self):
+        super(SOAPTest, self).setUp()
+
+        self.spg_server = FakeSPG()
+
+        spg = self.add_gateway(token='spg-token', soap_url=self.spg_server.url)
+        self.spg_id = spg.id
+        self.sync_client = self.add_sync_client(spg)
+        self.db.commit()
+
+        self.client = SOAPClient(
+            'http://{0}:{1}/soap/?spid=0123&token=spg-token'.format(
+                *self.address), 'SPG/SoapServer')
+
+        self.invoke_id = 0
+
+    def tearDown(self):
+        self.spg_server.stop()
+
+        super(SOAPTest, self).tearDown()
+
+    def header(self, invoke_id=None):
+        if invoke_id is None:
+            self.invoke_id += 1
+            invoke_id = self.invoke_id
+
+        return libspg.MessageHeader(service_prov_id='0123',
+                                    invoke_id=invoke_id,
+                                    message_date_time=datetime.utcnow())
+
+    def send(self, msg_obj):
+        """Send a message to the application
+
+        :return: The application result and the replies sent to the SPG
+        """
+
+        del self.spg_server.messages[:]
+
+        result = self.client.processResponse(
+            header='0123|{0}|0'.format(msg_obj.invoke_id),
+            xmlMessage=str(msg_obj))
+
+        return result, list(self.spg_server.messages)
+
+    def create(self, version_id, tn, invoke_id=None, **kwargs):
+        data = dict(
+            subscription_recipient_sp='0321',
+            subscription_recipient_eot='321',
+            subscription_activation_timestamp=datetime(2015, 1, 2, 3, 4, 5),
+            subscription_rn1='55321',
+            subscription_lnp_type='lspp',
+            subscription_download_reason='new',
+            subscription_line_type='Basic',
+            subscription_new_cnl='11000',
+        )
+        data.update(kwargs)
+
+        return self.send(SVCreateDownload(
+            self.header(invoke_id), libspg.SubscriptionVersionData(
+                libspg.TNVersionId(tn=tn, version_id=version_id),
+                libspg.SubscriptionData(**data))))
+
+    def delete(self, version_id):
+        return self.send(SVDeleteDownload(
+            self.header(), libspg.SubscriptionVersionDeleteData(
+                version_id, libspg.SubscriptionDownloadDeleteData('delete'))))
+
+    def query(self, expression):
+        return self.send(QueryBdoSVs(
+            self.header(), libspg.QueryBdoSVsData(expression)))
+
+    def subscription_versions(self):
+        self.db.expire_all()
+
+        return dict((sv.subscription_version_id, sv) for sv in self.db.query(
+            SubscriptionVersion).filter_by(
+            service_provider_gateway_id=self.spg_id))
+
+    def data_version(self):
+        self.db.expire_all()
+
+        return self.db.query(ServiceProviderGateway).get(
+            self.spg_id).data_version
+
+    def sync_tasks(self):
+        return [version_id for (version_id,) in self.db.query(
+            SubscriptionVersion.subscription_version_id
+        ).join(
+            SyncTask,
+            SyncTask.subscription_version_id == SubscriptionVersion.id,
+        ).filter(
+            SyncTask.sync_client_id == self.sync_client.id
+        ).order_by(SyncTask.id)]
+
+    def assertReply(self, replies, reply_class, invoke_id=None):
+        self.assertEqual(len(replies), 1)
+        self.assertIsInstance(replies[0], reply_class)
+        self.assertEqual(replies[0].invoke_id, invoke_id or self.invoke_id)
+
+    def test_create(self):
+        result, replies = self.create(1, '1130001000')
+
+        self.assertEqual(result, ('0',))
+        self.assertReply(replies, DownloadReply)
+        self.assertEqual(
+            replies[0].message_content.status, 'success')
+
+        sv = self.subscription_versions()[1]
+        self.assertEqual(sv.subscription_version_tn, '1130001000')
+        self.assertEqual(sv.subscription_rn1, '55321')
+        self.assertIsNone(sv.subscription_deletion_timestamp)
+
+        self.assertEqual(self.sync_tasks(), [1])
+        self.assertEqual(self.data_version(), 1)
+
+        # Modified
+        self.assertEqual(self.create(1, '1130001000', subscription_rn1='55456',
+                                     subscription_download_reason='modified'
+                                     )[0], ('0',))
+        self.assertEqual(
+            self.subscription_versions()[1].subscription_rn1, '55456')
+
+        # Coalesced sync tasks
+        self.assertEqual(self.sync_tasks(), [1])
+        self.assertEqual(self.data_version(), 2)
+
+    def test_retransmission(self):
+        replies = self.create(1, '1130001000')[1]
+
+        result, retransmitted = self.create(1, '1130001000', self.invoke_id,
+                                            subscription_rn1='55456')
+
+        # Not processed again, the recorded reply is sent again
+        self.assertEqual(result, ('0',))
+        self.assertEqual(str(retransmitted[0]), str(replies[0]))
+        self.assertEqual(
+            self.subscription_versions()[1].subscription_rn1, '55321')
+        self.assertEqual(self.data_version(), 1)
+
+    def test_delete(self):
+        self.create(1, '1130001000')
+        self.create(2, '1130002000')
+
+        result, replies = self.delete(1)
+
+        self.assertEqual(result, ('0',))
+        self.assertReply(replies, DownloadReply)
+
+        svs = self.subscription_versions()
+        self.assertIsNotNone(svs[1].subscription_deletion_timestamp)
+        self.assertEqual(svs[1].subscription_download_reason, 'delete')
+        self.assertIsNone(svs[2].subscription_deletion_timestamp)
+
+        self.assertEqual(self.sync_tasks(), [2, 1])
+
+        # Not created yet
+        self.assertEqual(self.delete(3)[0], ('0',))
+        self.assertIsNotNone(
+            self.subscription_versions()[3].subscription_deletion_timestamp)
+
+    def test_query(self):
+        self.create(1, '1130001000')
+        self.create(2, '1130002000')
+        self.create(3, '11930003000')
+        self.delete(2)
+
+        result, replies = self.query(
+            '"subscription_version_tn LIKE \'1130%\'"')
+
+        self.assertEqual(result, ('0',))
+        self.assertReply(replies, QueryBdoSVsReply)
+        self.assertEqual(
+            [sv.subscription_tn_version_id.version_id
+             for sv in replies[0].message_content], [1])
+
+        # Cached results are expired by the changes
+        self.create(4, '1130004000')
+
+        self.assertEqual(
+            [sv.subscription_tn_version_id.version_id
+             for sv in self.query("subscription_version_tn LIKE '1130%'")[1][
+                0].message_content], [1, 4])
+
+    def test_query_invalid(self):
+        result, replies = self.query('subscription_version_id = 1 OR 1=1')
+
+        self.assertEqual(result, ('-1',))
+        self.assertEqual(replies, [])
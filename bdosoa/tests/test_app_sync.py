@@ -0,0 +1,111 @@
+"""
+bdosoa - Subscription Versions syncing tests
+"""
+
+import json
+import threading
+import time
+
+from bdosoa.app import App
+from bdosoa.model import SyncTask
+from bdosoa.tests import ServerTestCase
+
+
+class SyncTest(ServerTestCase):
+
+    def setUp(self):
+        super(SyncTest, self).setUp()
+
+        spg = self.add_gateway()
+        self.sync_client = self.add_sync_client(spg)
+
+        for version_id in range(1, 6):
+            sv = self.add_subscription_version(
+                spg, version_id, '11300{0:02d}000'.format(version_id))
+            self.db.add(SyncTask(sync_client_id=self.sync_client.id,
+                                 subscription_version_id=sv.id))
+
+        self.db.commit()
+        self.tasks = self.pending()
+
+    def pending(self):
+        self.db.expire_all()
+
+        return [task.id for task in self.db.query(SyncTask).order_by(
+            SyncTask.id)]
+
+    def sync(self, method, query='', body=None, headers=None):
+        return self.request(
+            method, '/sync/?spid=0123&token=sync-token' + query, body, headers)
+
+    def test_list(self):
+        status, headers, body = self.sync('GET')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), self.tasks)
+
+    def test_delete(self):
+        status = self.sync('DELETE', '&task={0}&task={1}'.format(
+            *self.tasks[:2]))[0]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.pending(), self.tasks[2:])
+
+    def test_delete_upto(self):
+        status = self.sync('DELETE', '&upto={0}'.format(self.tasks[2]))[0]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.pending(), self.tasks[3:])
+
+    def test_delete_json_body(self):
+        status = self.sync(
+            'DELETE', body=json.dumps({'tasks': [self.tasks[4]],
+                                       'upto': self.tasks[0]}),
+            headers={'Content-Type': 'application/json'})[0]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.pending(), self.tasks[1:4])
+
+    def test_delete_without_body(self):
+        # Sent without Content-Length, as the existing clients do
+        status = self.sync('DELETE', '&task={0}'.format(self.tasks[0]),
+                           headers={'Content-Type': 'application/json'})[0]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.pending(), self.tasks[1:])
+
+    def test_delete_invalid_body(self):
+        status = self.sync('DELETE', body='[1, ',
+                           headers={'Content-Type': 'application/json'})[0]
+
+        self.assertEqual(status, 400)
+        self.assertEqual(self.pending(), self.tasks)
+
+    def test_delete_nothing(self):
+        self.assertEqual(self.sync('DELETE')[0], 404)
+
+    def test_wait(self):
+        after = '&after={0}&wait=0.5'.format(self.tasks[-1])
+
+        start = time.time()
+        status, headers, body = self.sync('GET', after)
+
+        self.assertEqual((status, json.loads(body)), (200, []))
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+    def test_wait_concurrency(self):
+        after = '&after={0}&wait=30'.format(self.tasks[-1])
+        waiters = App.root.sync.waiters
+
+        # Too many waiting requests, answered right away
+        App.root.sync.waiters = threading.Semaphore(0)
+
+        try:
+            start = time.time()
+            status, headers, body = self.sync('GET', after)
+
+        finally:
+            App.root.sync.waiters = waiters
+
+        self.assertEqual((status, json.loads(body)), (200, []))
+        self.assertLess(time.time() - start, 5)
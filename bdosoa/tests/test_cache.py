@@ -0,0 +1,73 @@
+"""
+bdosoa - in-process caches tests
+"""
+
+import time
+import unittest
+
+from bdosoa.lib.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_none_value(self):
+        cache = LRUCache()
+        cache.set('a', None)
+
+        self.assertIn('a', cache)
+
+    def test_max_size(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Mark as most recently used
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 4)
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.bytes, 8)
+
+        # Replaced entries free their size
+        cache.set('b', 'x')
+        self.assertEqual(cache.bytes, 5)
+
+        # Larger than the limit, not cached
+        cache.set('d', 'x' * 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.bytes, 5)
+
+        self.assertEqual(cache.pop('c'), 'x' * 4)
+        self.assertEqual(cache.bytes, 1)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
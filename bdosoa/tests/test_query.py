@@ -0,0 +1,166 @@
+"""
+bdosoa - SPG query expressions compiler tests
+"""
+
+import sqlalchemy
+import unittest
+import warnings
+
+from datetime import datetime
+
+from bdosoa.app.soap import SOAP
+from bdosoa.lib.query import QueryCompiler, normalize, tokenize, unquote
+from bdosoa.model import SubscriptionVersion
+from bdosoa.tests import DatabaseTestCase
+
+#: Columns allowed on the expressions, as on the SOAP application
+COLUMNS = dict((column.name, column)
+               for column in SubscriptionVersion.__table__.columns
+               if column.name.startswith('subscription_'))
+
+#: Expressions sent by the gateways, valid as SQL WHERE clauses
+EXPRESSIONS = [
+    "subscription_version_tn = '1130001000'",
+    "subscription_version_tn <> '1130001000'",
+    "subscription_version_tn LIKE '11300%'",
+    "subscription_version_tn NOT LIKE '11300%'",
+    "subscription_version_tn LIKE '1193000_000'",
+    "subscription_version_tn IN ('1130001000', '11930003000')",
+    "subscription_version_id IN (1, 3, 5)",
+    "subscription_version_id NOT IN (1, 3)",
+    "subscription_version_id BETWEEN 2 AND 4",
+    "subscription_version_id >= 2 AND subscription_lnp_type = 'lisp'",
+    "subscription_version_id = 1 OR subscription_version_id = 4",
+    "(subscription_version_id = 1 OR subscription_version_id = 2) "
+    "AND subscription_line_type = 'Basic'",
+    "NOT subscription_version_id = 1",
+    "NOT (subscription_version_id < 2 OR subscription_version_id > 3)",
+    "SUBSCRIPTION_VERSION_TN = '1130001000'",
+    "Subscription_Version_Id in (2, 3) and subscription_rn1 = '55321'",
+    "subscription_version.subscription_version_id = 2",
+    "subscription_new_cnl IS NULL",
+    "subscription_new_cnl IS NOT NULL",
+    "subscription_optional_data = 'O''Brien'",
+    "subscription_activation_timestamp >= '2015-03-01'",
+    "subscription_recipient_sp = '0321' AND "
+    "subscription_download_reason <> 'new'",
+    "  subscription_version_id=2  ",
+]
+
+#: Expressions refused before reaching the database
+INVALID_EXPRESSIONS = [
+    "",
+    "   ",
+    '""',
+    "foo = 1",
+    "service_provider_gateway_id = 1",
+    "subscription_version_id = 1 OR 1=1",
+    "subscription_version_id = 1 OR 1",
+    "subscription_version_id = 1; DELETE FROM subscription_version",
+    "subscription_version_id = 1 -- comment",
+    "subscription_version_id IN (SELECT id FROM service_provider_gateway)",
+    "subscription_version_id = 'abc'",
+    "subscription_activation_timestamp > 'yesterday'",
+    "subscription_version_id =",
+    "subscription_version_id = 1 AND",
+    "(subscription_version_id = 1",
+    "subscription_version_id = 1)",
+    "subscription_version_tn = lower(subscription_rn1)",
+]
+
+
+class QueryCompilerTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(QueryCompilerTest, self).setUp()
+
+        self.spg = self.add_gateway()
+        self.add_subscription_version(self.spg, 1, '1130001000')
+        self.add_subscription_version(
+            self.spg, 2, '1130002000', subscription_new_cnl=None,
+            subscription_optional_data="O'Brien",
+            subscription_activation_timestamp=datetime(2015, 4, 5))
+        self.add_subscription_version(
+            self.spg, 3, '11930003000', subscription_lnp_type='lisp',
+            subscription_download_reason='modified',
+            subscription_line_type='DDR')
+        self.add_subscription_version(
+            self.spg, 4, '11930004000', subscription_lnp_type='lisp',
+            subscription_activation_timestamp=datetime(2015, 5, 6))
+
+        # Deleted and other gateways subscription versions are not listed
+        self.add_subscription_version(
+            self.spg, 5, '1130005000',
+            subscription_deletion_timestamp=datetime(2015, 6, 7))
+        self.add_subscription_version(self.add_gateway('0456'), 1,
+                                      '1130001000')
+        self.db.commit()
+
+        self.compiler = QueryCompiler(COLUMNS, SOAP.sv_query)
+
+    def baseline(self, expression):
+        """Query the subscription versions with the raw SQL filter"""
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+
+            return sorted(sv.subscription_version_id for sv in self.db.query(
+                SubscriptionVersion
+            ).filter_by(
+                service_provider_gateway_id=self.spg.id,
+                subscription_deletion_timestamp=None,
+            ).filter(sqlalchemy.text(expression)))
+
+    def compiled(self, expression):
+        """Query the subscription versions with the compiled statement"""
+
+        statement = self.compiler.compile(expression)[1]
+
+        return sorted(row.subscription_version_id for row in self.db.execute(
+            statement, {'spg_id': self.spg.id}))
+
+    def test_baseline(self):
+        for expression in EXPRESSIONS:
+            baseline = self.baseline(expression)
+
+            self.assertEqual(self.compiled(expression), baseline, expression)
+
+    def test_results(self):
+        self.assertEqual(self.compiled(EXPRESSIONS[0]), [1])
+        self.assertEqual(self.compiled(EXPRESSIONS[2]), [1, 2])
+        self.assertEqual(self.compiled(EXPRESSIONS[8]), [2, 3, 4])
+
+    def test_quoted(self):
+        for expression in EXPRESSIONS:
+            quoted = '" {0} "'.format(expression.strip())
+
+            self.assertEqual(self.compiled(unquote(quoted)),
+                             self.baseline(expression), quoted)
+
+    def test_invalid(self):
+        for expression in INVALID_EXPRESSIONS:
+            self.assertRaises(ValueError, self.compiled, unquote(expression))
+
+    def test_cache(self):
+        key, statement = self.compiler.compile(
+            "subscription_version_id in (1,2) and subscription_rn1='55321'")
+
+        self.assertEqual(self.compiler.compile(
+            'SUBSCRIPTION_VERSION_ID IN ( 1, 2 ) && subscription_rn1 = "55321"'
+        ), (key, statement))
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_aliases(self):
+        self.assertEqual(
+            normalize(tokenize("NOT a == 1 && b != 'x' || !c <> 2")),
+            "NOT a = 1 AND b <> 'x' OR NOT c <> 2")
+
+    def test_strings(self):
+        self.assertEqual(normalize(tokenize('a = "it\'s" OR b = \'""\'')),
+                         "a = 'it''s' OR b = '\"\"'")
+
+    def test_unquote(self):
+        self.assertEqual(unquote('"a = 1"'), 'a = 1')
+        self.assertEqual(unquote("a = \"1\""), 'a = "1"')
@@ -0,0 +1,114 @@
+"""
+bdosoa - TN routing table tests
+"""
+
+import itertools
+import unittest
+
+from bdosoa.lib.routing import RoutingTable
+
+#: Changes of a TN, ported twice and removed
+CHANGES = [
+    ('update', '1130001000', 1, '55321', '0321', '11000'),
+    ('update', '1130001000', 2, '55456', '0456', '11000'),
+    ('delete', '1130001000', 2),
+    ('update', '1130001000', 3, '55789', '0789', '11000'),
+    ('delete', '1130001000', 3),
+]
+
+
+def route(version_id, rn1, recipient_sp='0321', cnl='11000'):
+    return {
+        'version_id': version_id,
+        'rn1': rn1,
+        'recipient_sp': recipient_sp,
+        'cnl': cnl,
+    }
+
+
+class RoutingTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable(max_overlay=2)
+        self.table.load([
+            ('1130001000', 1, '55321', '0321', '11000'),
+            ('1130002000', 2, '55321', '0321', '11000'),
+            ('1130002000', 3, '55456', '0456', '11000'),
+            ('1130003000', 4, '55321', '0321', '11000'),
+            # Unsorted and invalid rows
+            ('1130000000', 5, '55789', '0789', '11000'),
+            ('11300X0000', 6, '55321', '0321', '11000'),
+        ])
+
+    def test_load(self):
+        self.assertEqual(self.table.lookup([
+            '1130000000', '1130001000', '1130002000', '1130004000',
+            '11300X0000',
+        ]), {
+            '1130000000': route(5, '55789', '0789'),
+            '1130001000': route(1, '55321'),
+            '1130002000': route(3, '55456', '0456'),
+            '1130004000': None,
+            '11300X0000': None,
+        })
+
+        self.assertEqual(list(self.table.base[0]), [
+            1130000000, 1130001000, 1130002000, 1130003000])
+
+        # Routes are shared by the TNs
+        self.assertEqual(len(self.table.routes), 1 + 3)
+
+    def test_changes(self):
+        self.table.update('1130001000', 7, '55456', '0456', '11000')
+        self.table.update('1130002000', 2, '55321', '0321', '11000')
+        self.table.delete('1130003000', 4)
+        self.table.update('1130004000', 8, '55321', '0321', '11000')
+
+        self.assertEqual(self.table.lookup([
+            '1130001000', '1130002000', '1130003000', '1130004000',
+        ]), {
+            '1130001000': route(7, '55456', '0456'),
+            '1130002000': route(3, '55456', '0456'),
+            '1130003000': None,
+            '1130004000': route(8, '55321'),
+        })
+
+        # Merged once the overlay is full
+        self.assertEqual(len(self.table.overlay), 1)
+        self.assertIn(1130003000, self.table.base[0])
+
+
+class RoutingTableOrderTest(unittest.TestCase):
+
+    def apply(self, table, changes):
+        for change in changes:
+            getattr(table, change[0])(*change[1:])
+
+    def assertAnyOrder(self, changes, expected, max_overlay):
+        for order in itertools.permutations(changes):
+            table = RoutingTable(max_overlay=max_overlay)
+            self.apply(table, order)
+
+            self.assertEqual(table.lookup(['1130001000'])['1130001000'],
+                             expected, order)
+
+    def test_any_order(self):
+        for max_overlay in (1, 2, 10):
+            self.assertAnyOrder(CHANGES, None, max_overlay)
+            self.assertAnyOrder(CHANGES[:4], {
+                'version_id': 3,
+                'rn1': '55789',
+                'recipient_sp': '0789',
+                'cnl': '11000',
+            }, max_overlay)
+
+    def test_removed_after_compaction(self):
+        table = RoutingTable(max_overlay=1)
+        table.update('1130001000', 2, '55456', '0456', '11000')
+        table.delete('1130001000', 2)
+
+        # Older change received after the removal was merged
+        table.update('1130001000', 1, '55321', '0321', '11000')
+
+        self.assertEqual(table.lookup(['1130001000']),
+                         {'1130001000': None})
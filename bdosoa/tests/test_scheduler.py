@@ -0,0 +1,84 @@
+"""
+bdosoa - keyed work scheduler tests
+"""
+
+import threading
+import unittest
+
+from bdosoa.lib.scheduler import LaneScheduler, Task
+
+
+class TaskTest(unittest.TestCase):
+
+    def test_result(self):
+        task = Task(lambda a, b: a + b, (1, 2))
+        task()
+
+        self.assertEqual(task.wait(), 3)
+
+    def test_error(self):
+        task = Task(lambda: 1 / 0, ())
+        task()
+
+        self.assertRaises(ZeroDivisionError, task.wait)
+
+    def test_timeout(self):
+        self.assertRaises(RuntimeError, Task(None, ()).wait, 0.01)
+
+
+class LaneSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = LaneScheduler(lanes=4)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_lane(self):
+        self.assertEqual(self.scheduler.lane(('a', 1)),
+                         self.scheduler.lane(('a', 1)))
+        self.assertIn(self.scheduler.lane('b'), range(len(self.scheduler)))
+
+    def test_key_order(self):
+        results = []
+        tasks = [self.scheduler.submit('key', results.append, i)
+                 for i in range(100)]
+
+        for task in tasks:
+            task.wait(5)
+
+        self.assertEqual(results, range(100))
+
+    def test_parallel(self):
+        blocked = threading.Event()
+
+        # Keys on different lanes
+        keys = {}
+        key = 0
+
+        while len(keys) < 2:
+            keys.setdefault(self.scheduler.lane(key), key)
+            key += 1
+
+        first, second = keys.values()
+
+        self.scheduler.submit(first, blocked.wait, 5)
+
+        # Not waiting for the blocked lane
+        self.assertEqual(
+            self.scheduler.submit(second, lambda: 'done').wait(5), 'done')
+
+        blocked.set()
+
+    def test_stop(self):
+        results = []
+
+        for i in range(10):
+            self.scheduler.submit(i, results.append, i)
+
+        self.scheduler.stop()
+
+        self.assertEqual(sorted(results), range(10))
+        self.assertEqual(sum(self.scheduler.processed), 10)
+        self.assertEqual(self.scheduler.depths(), [0] * 4)
@@ -0,0 +1,117 @@
+"""
+bdosoa - SOAP processing routines tests
+"""
+
+import errno
+import httplib
+import socket
+import unittest
+
+from bdosoa.lib.soap import HTTPConnectionPool
+
+
+class FakeResponse(object):
+
+    status = 200
+    will_close = False
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def read(self):
+        if self.error is not None:
+            raise self.error
+
+        return 'OK'
+
+
+class FakeConnection(object):
+    """Connection failing with the given errors"""
+
+    def __init__(self, send_error=None, response_error=None,
+                 read_error=None):
+        self.send_error = send_error
+        self.response_error = response_error
+        self.read_error = read_error
+        self.closed = False
+
+    def request(self, method, path, body, headers):
+        if self.send_error is not None:
+            raise self.send_error
+
+    def getresponse(self):
+        if self.response_error is not None:
+            raise self.response_error
+
+        return FakeResponse(self.read_error)
+
+    def close(self):
+        self.closed = True
+
+
+class HTTPConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = HTTPConnectionPool('http://spg.example.com/')
+        self.connections = []
+
+        self.pool.get = lambda: self.connections.pop(0)
+
+    def request(self, reused, **errors):
+        """Send a request on a connection failing with the given errors,
+        followed by a working new connection
+
+        :return: The failed connection
+        """
+
+        failed = FakeConnection(**errors)
+        self.connections = [(failed, reused), (FakeConnection(), False)]
+
+        try:
+            self.assertEqual(self.pool.request('POST', 'body'), (200, 'OK'))
+
+        finally:
+            self.assertTrue(failed.closed)
+
+    def assertRetried(self, **errors):
+        self.request(True, **errors)
+        self.assertEqual(self.connections, [])
+
+    def assertNotRetried(self, error, reused=True, **errors):
+        self.assertRaises(error, self.request, reused, **errors)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_send_failure(self):
+        self.assertRetried(send_error=socket.error(errno.EPIPE, 'Broken'))
+        self.assertRetried(send_error=httplib.CannotSendRequest())
+
+    def test_closed(self):
+        self.assertRetried(response_error=httplib.BadStatusLine("''"))
+        self.assertRetried(response_error=httplib.BadStatusLine(
+            'No status line received - the server has closed the connection'))
+
+    def test_reset(self):
+        self.assertRetried(
+            response_error=socket.error(errno.ECONNRESET, 'Reset'))
+
+    def test_timeout(self):
+        self.assertNotRetried(socket.timeout, send_error=socket.timeout())
+        self.assertNotRetried(socket.timeout,
+                              response_error=socket.timeout())
+
+    def test_response_failure(self):
+        self.assertNotRetried(
+            httplib.BadStatusLine,
+            response_error=httplib.BadStatusLine('HTTP/1.1 abc'))
+        self.assertNotRetried(
+            socket.error,
+            response_error=socket.error(errno.ETIMEDOUT, 'Timed out'))
+        self.assertNotRetried(httplib.IncompleteRead,
+                              read_error=httplib.IncompleteRead('O'))
+
+    def test_new_connection(self):
+        self.assertNotRetried(socket.error, reused=False,
+                              send_error=socket.error(errno.EPIPE, 'Broken'))
+        self.assertNotRetried(
+            httplib.BadStatusLine, reused=False,
+            response_error=httplib.BadStatusLine("''"))
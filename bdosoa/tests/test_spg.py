@@ -0,0 +1,113 @@
+"""
+bdosoa - SPG messages helpers tests
+"""
+
+import libspg
+
+from datetime import datetime
+from libspg.bdo import QueryBdoSVsReply
+from lxml import etree
+from sqlalchemy import select
+
+from bdosoa.lib.spg import QueryBdoSVsStreamReply
+from bdosoa.model import SubscriptionVersion
+from bdosoa.tests import DatabaseTestCase
+
+
+def canonical(xml):
+    """Serialize a XML document without the formatting whitespace
+
+    :param str xml: XML document
+    :rtype: str
+    """
+
+    parser = etree.XMLParser(remove_blank_text=True)
+
+    return etree.tostring(etree.fromstring(xml, parser), method='c14n')
+
+
+class QueryBdoSVsStreamReplyTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(QueryBdoSVsStreamReplyTest, self).setUp()
+
+        self.header = libspg.MessageHeader(
+            service_prov_id='0123', invoke_id=42,
+            message_date_time=datetime(2015, 6, 7, 8, 9, 10))
+
+        spg = self.add_gateway()
+        self.add_subscription_version(spg, 1, '1130001000')
+        self.add_subscription_version(
+            spg, 2, '1130002000',
+            subscription_broadcast_timestamp=datetime(2015, 2, 3, 4, 5, 6),
+            subscription_new_cnl=None,
+            subscription_optional_data=u'<opcional> & "dados" \xe7',
+            subscription_line_type='DDR')
+        self.add_subscription_version(
+            spg, 3, '11930003000', subscription_lnp_type='lisp',
+            subscription_download_reason='modified')
+        self.db.commit()
+
+    def rows(self):
+        return self.db.execute(
+            select([SubscriptionVersion.__table__])
+            .order_by(SubscriptionVersion.subscription_version_id))
+
+    def baseline(self):
+        """Build the reply the way it was built before streaming"""
+
+        return str(QueryBdoSVsReply(self.header, [
+            libspg.SubscriptionVersionData(
+                libspg.TNVersionId(
+                    tn=sv.subscription_version_tn,
+                    version_id=sv.subscription_version_id,
+                ),
+                libspg.SubscriptionData(
+                    subscription_recipient_sp=sv.subscription_recipient_sp,
+                    subscription_recipient_eot=sv.subscription_recipient_eot,
+                    subscription_activation_timestamp=sv.subscription_activation_timestamp,
+                    broadcast_window_start_timestamp=sv.subscription_broadcast_timestamp,
+                    subscription_rn1=sv.subscription_rn1,
+                    subscription_new_cnl=sv.subscription_new_cnl,
+                    subscription_lnp_type=sv.subscription_lnp_type,
+                    subscription_download_reason=sv.subscription_download_reason,
+                    subscription_line_type=sv.subscription_line_type,
+                    subscription_optional_data=sv.subscription_optional_data,
+                )
+            )
+            for sv in self.rows()
+        ]))
+
+    def test_rows(self):
+        reply = QueryBdoSVsStreamReply(self.header, self.rows(), chunk_size=2)
+
+        self.assertEqual(canonical(str(reply)), canonical(self.baseline()))
+        self.assertEqual(reply.count, 3)
+
+    def test_cached_content(self):
+        reply = QueryBdoSVsStreamReply(self.header, self.rows())
+        str(reply)
+
+        cached = QueryBdoSVsStreamReply(self.header, content=reply.content,
+                                        count=reply.count)
+
+        self.assertEqual(canonical(str(cached)), canonical(self.baseline()))
+
+    def test_empty(self):
+        self.db.query(SubscriptionVersion).delete()
+        self.db.commit()
+
+        reply = QueryBdoSVsStreamReply(self.header, self.rows())
+
+        self.assertEqual(canonical(str(reply)), canonical(self.baseline()))
+        self.assertEqual(reply.count, 0)
+
+    def test_parse(self):
+        reply = QueryBdoSVsStreamReply(self.header, self.rows())
+        msg_obj = libspg.Message.from_string(str(reply))
+
+        self.assertIsInstance(msg_obj, QueryBdoSVsReply)
+        self.assertEqual(msg_obj.invoke_id, 42)
+        self.assertEqual(
+            [sv.subscription_tn_version_id.version_id
+             for sv in msg_obj.message_content], [1, 2, 3])
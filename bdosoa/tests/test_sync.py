@@ -0,0 +1,155 @@
+"""
+bdosoa - sync storage modes tests
+"""
+
+from bdosoa.lib.sync import ChangeLogStorage, TaskStorage
+from bdosoa.model import SVChange, SyncClient, SyncTask
+from bdosoa.tests import DatabaseTestCase
+
+
+class StorageTestMixin(object):
+    """Behaviour common to the sync storages"""
+
+    storage = None
+
+    #: Whether acknowledging a task acknowledges the previous ones
+    cumulative = False
+
+    def setUp(self):
+        super(StorageTestMixin, self).setUp()
+
+        self.spg = self.add_gateway()
+        self.client = self.add_sync_client(self.spg)
+        self.other_client = self.add_sync_client(self.spg, 'other-token')
+        self.disabled_client = self.add_sync_client(
+            self.spg, 'disabled-token', enabled=False)
+
+        self.svs = [self.add_subscription_version(
+            self.spg, version_id, '11300{0:02d}000'.format(version_id)).id
+            for version_id in range(1, 6)]
+
+        # Other gateways changes are not listed
+        other_spg = self.add_gateway('0456')
+        self.add_sync_client(other_spg, self.client.token)
+        self.storage.create(self.db, other_spg.id,
+                            self.add_subscription_version(
+                                other_spg, 1, '1130001000').id)
+
+        for sv_id in self.svs:
+            self.storage.create(self.db, self.spg.id, sv_id)
+
+    def pending(self, sync_client, after=0, upto=None):
+        return [task_id for (task_id,) in self.db.execute(
+            self.storage.pending(self.snapshot(sync_client), after, upto))]
+
+    def snapshot(self, sync_client):
+        self.db.expire(sync_client)
+
+        return sync_client.snapshot()
+
+    def svs_of(self, sync_client, tasks):
+        return sorted(row.id for row in self.db.execute(
+            self.storage.details(self.snapshot(sync_client), tasks)))
+
+    def delete(self, sync_client, tasks, upto=None):
+        self.storage.delete(self.db, self.snapshot(sync_client), tasks, upto,
+                            chunk_size=2)
+
+    def test_pending(self):
+        tasks = self.pending(self.client)
+
+        self.assertEqual(len(tasks), 5)
+        self.assertEqual(tasks, sorted(tasks))
+        self.assertEqual(self.svs_of(self.client, tasks), self.svs)
+        self.assertEqual(self.svs_of(self.other_client,
+                                     self.pending(self.other_client)),
+                         self.svs)
+
+        self.assertEqual(self.pending(self.client, tasks[1], tasks[3]),
+                         tasks[2:4])
+        self.assertEqual(self.db.execute(self.storage.position(
+            self.snapshot(self.client))).scalar(), tasks[-1])
+
+    def test_coalesce(self):
+        tasks = self.pending(self.client)
+        self.storage.create(self.db, self.spg.id, self.svs[0])
+
+        pending = self.pending(self.client)
+
+        # Replaced by a single newer task
+        self.assertEqual(pending[:-1], tasks[1:])
+        self.assertGreater(pending[-1], tasks[-1])
+        self.assertEqual(self.svs_of(self.client, pending[-1:]),
+                         self.svs[:1])
+
+    def test_delete(self):
+        tasks = self.pending(self.client)
+        self.delete(self.client, [tasks[4]], upto=tasks[0])
+
+        self.assertEqual(self.pending(self.client),
+                         [] if self.cumulative else tasks[1:4])
+
+        # Other clients keep their tasks
+        self.assertEqual(len(self.pending(self.other_client)), 5)
+
+
+class TaskStorageTest(StorageTestMixin, DatabaseTestCase):
+
+    storage = TaskStorage()
+
+    def test_clients(self):
+        # A task by enabled client
+        self.assertEqual(self.db.query(SyncTask).filter_by(
+            sync_client_id=self.disabled_client.id).count(), 0)
+        self.assertEqual(self.db.query(SyncTask).filter(
+            SyncTask.subscription_version_id.in_(self.svs)).count(), 10)
+
+    def test_delete_chunks(self):
+        tasks = self.pending(self.client)
+        self.delete(self.client, tasks[:3] + [max(tasks) + 1])
+
+        self.assertEqual(self.pending(self.client), tasks[3:])
+
+
+class ChangeLogStorageTest(StorageTestMixin, DatabaseTestCase):
+
+    storage = ChangeLogStorage()
+    cumulative = True
+
+    def test_changes(self):
+        # A change by subscription version, whatever the number of clients
+        self.assertEqual(self.db.query(SVChange).filter_by(
+            service_provider_gateway_id=self.spg.id).count(), 5)
+
+    def test_cursor(self):
+        tasks = self.pending(self.client)
+        self.delete(self.client, tasks[:2])
+
+        self.assertEqual(self.pending(self.client), tasks[2:])
+        self.assertEqual(self.snapshot(self.client).change_cursor, tasks[1])
+
+        # The cursor never moves back
+        self.delete(self.client, tasks[:1])
+        self.assertEqual(self.snapshot(self.client).change_cursor, tasks[1])
+
+        # Changes not created yet are not acknowledged
+        self.delete(self.client, [], upto=tasks[-1] + 10)
+        self.assertEqual(self.snapshot(self.client).change_cursor, tasks[-1])
+
+    def test_truncate(self):
+        tasks = self.pending(self.client)
+        self.delete(self.client, [], upto=tasks[2])
+        self.delete(self.other_client, [], upto=tasks[1])
+
+        # Acknowledged by the enabled clients, the disabled one is ignored
+        self.assertEqual(self.storage.truncate(self.db), 2)
+        self.assertEqual(self.pending(self.client), tasks[3:])
+        self.assertEqual(self.pending(self.other_client), tasks[2:])
+
+        self.db.query(SyncClient).filter_by(
+            service_provider_gateway_id=self.spg.id).update(
+            {'enabled': False})
+
+        # Gateways without enabled clients keep no changes
+        self.assertEqual(self.storage.truncate(self.db), 3)
+        self.assertEqual(self.db.query(SVChange).count(), 1)
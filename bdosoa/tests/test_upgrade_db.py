@@ -0,0 +1,123 @@
+"""
+bdosoa - database schema upgrade tests
+"""
+
+import sqlalchemy
+import unittest
+
+from sqlalchemy.pool import StaticPool
+
+from bdosoa.model.meta import Base
+from bdosoa.scripts.upgrade_db import upgrade
+from bdosoa.tests import create_engine
+
+#: Schema before the gateway data version and the sync change log
+BASELINE_SCHEMA = [
+    """CREATE TABLE service_provider_gateway (
+        id INTEGER NOT NULL PRIMARY KEY,
+        service_provider_id VARCHAR NOT NULL,
+        token VARCHAR NOT NULL,
+        soap_url VARCHAR NOT NULL,
+        description VARCHAR,
+        enabled BOOLEAN NOT NULL,
+        CONSTRAINT uq_service_provider_gateway_service_provider_id
+            UNIQUE (service_provider_id, token)
+    )""",
+    """CREATE INDEX ix_service_provider_gateway_service_provider_id
+        ON service_provider_gateway (service_provider_id)""",
+    """CREATE TABLE subscription_version (
+        id INTEGER NOT NULL PRIMARY KEY,
+        subscription_version_id INTEGER NOT NULL,
+        subscription_version_tn VARCHAR,
+        subscription_recipient_sp VARCHAR,
+        subscription_recipient_eot VARCHAR,
+        subscription_activation_timestamp DATETIME,
+        subscription_broadcast_timestamp DATETIME,
+        subscription_rn1 VARCHAR,
+        subscription_new_cnl VARCHAR,
+        subscription_lnp_type VARCHAR(4),
+        subscription_download_reason VARCHAR(8),
+        subscription_line_type VARCHAR(5),
+        subscription_optional_data TEXT,
+        subscription_deletion_timestamp DATETIME,
+        service_provider_gateway_id INTEGER NOT NULL
+            REFERENCES service_provider_gateway (id),
+        CONSTRAINT uq_subscription_version_service_provider_gateway_id
+            UNIQUE (service_provider_gateway_id, subscription_version_id)
+    )""",
+    """CREATE TABLE sync_client (
+        id INTEGER NOT NULL PRIMARY KEY,
+        token VARCHAR NOT NULL,
+        description VARCHAR,
+        enabled BOOLEAN NOT NULL,
+        service_provider_gateway_id INTEGER NOT NULL
+            REFERENCES service_provider_gateway (id),
+        CONSTRAINT uq_sync_client_service_provider_gateway_id
+            UNIQUE (service_provider_gateway_id, token)
+    )""",
+    """CREATE TABLE sync_task (
+        id INTEGER NOT NULL PRIMARY KEY,
+        sync_client_id INTEGER NOT NULL REFERENCES sync_client (id),
+        subscription_version_id INTEGER NOT NULL
+            REFERENCES subscription_version (id),
+        CONSTRAINT uq_sync_task_sync_client_id
+            UNIQUE (sync_client_id, subscription_version_id)
+    )""",
+    "INSERT INTO service_provider_gateway VALUES "
+    "(1, '0123', 'token', 'http://spg.example.com/', NULL, 1)",
+    "INSERT INTO sync_client VALUES (1, 'sync-token', NULL, 1, 1)",
+]
+
+
+class UpgradeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine(
+            'sqlite://', poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+
+        for statement in BASELINE_SCHEMA:
+            self.engine.execute(statement)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_upgrade(self):
+        changes = upgrade(self.engine)
+
+        self.assertIn('Add column service_provider_gateway.data_version',
+                      changes)
+        self.assertIn('Add column sync_client.change_cursor', changes)
+        self.assertIn('Create index ix_sync_task_sync_client_id_id', changes)
+        self.assertIn('Create table sv_change', changes)
+
+        # Existing rows get the column defaults
+        self.assertEqual(self.engine.execute(
+            'SELECT data_version FROM service_provider_gateway').scalar(), 0)
+        self.assertEqual(self.engine.execute(
+            'SELECT change_cursor FROM sync_client').scalar(), 0)
+
+        inspector = sqlalchemy.inspect(self.engine)
+
+        for table in Base.metadata.sorted_tables:
+            self.assertEqual(
+                set(column['name']
+                    for column in inspector.get_columns(table.name)),
+                set(table.columns.keys()), table.name)
+
+        # Already up to date
+        self.assertEqual(upgrade(self.engine), [])
+
+    def test_current(self):
+        engine = create_engine()
+
+        try:
+            self.assertEqual(upgrade(engine), [])
+
+        finally:
+            engine.dispose()
+
+    def test_dry_run(self):
+        changes = upgrade(self.engine, dry_run=True)
+
+        self.assertEqual(upgrade(self.engine), changes)